@@ -0,0 +1,504 @@
+"""
+ASGI-вариант API веб-версии keySecret.
+
+Повторяет JSON API Flask-приложения (вход/выход, /api/wallets,
+/api/wallets/changes, /api/wallets/<id>/secret, /api/requests,
+/api/requests/events) на голом ASGI без новых
+зависимостей. Цикл событий не занят вычислениями: проверка пароля идет
+в общем ограниченном пуле
+bcrypt, а расшифровка кошельков и обращения к БД — в отдельном пуле
+потоков. Поэтому один процесс держит много одновременных и простаивающих
+keep-alive соединений.
+
+Сессии берутся из того же хранилища, что и у web_app (session_store), под
+тем же именем cookie; с KS_SESSION_BACKEND=sqlite вход, выполненный в одном
+приложении, действует и в другом.
+
+Запуск под любым ASGI-сервером, например:
+    uvicorn asgi_app:app --host 0.0.0.0 --port 8000 --workers 4
+"""
+
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie, CookieError
+from itertools import islice
+from urllib.parse import parse_qs
+
+from init_db import (
+    init,
+    check_user,
+    add_wallet,
+    iter_wallets,
+    get_wallet_secret,
+    wallet_changes,
+    wallet_owner_id,
+    send_master_key_request,
+    REQUEST_ALREADY_PENDING,
+    get_received_requests,
+    request_changes,
+    REQUEST_STATUSES,
+    get_change_version,
+    version_etag,
+    wallets_scope,
+    requests_scope,
+    respond_to_request,
+    forget_master_key,
+    SCAN_BATCH,
+)
+from password_hashing import hashing_executor, HashingBusy, HASH_TIMEOUT
+from events import subscribe, sse_message, KEEPALIVE, QUEUE_SIZE
+from rate_limit import request_limiter, retry_after
+from session_store import create_store, new_session_id
+
+
+SESSION_COOKIE = "session"  # то же имя, что у Flask
+MAX_PAGE_SIZE = 1000
+MAX_BODY = int(os.environ.get("KS_ASGI_MAX_BODY", str(1024 * 1024)))
+BLOCKING_WORKERS = int(os.environ.get("KS_ASGI_THREADS", str(min(32, (os.cpu_count() or 1) + 4))))
+
+_blocking = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="ks-asgi")
+
+
+def _discard_session(data):
+    forget_master_key(data.get("master_key"))
+
+
+sessions = create_store(on_discard=_discard_session)
+
+
+async def run_blocking(fn, *args):
+    """Выполняет блокирующую функцию (БД, расшифровка) вне цикла событий."""
+    return await asyncio.get_running_loop().run_in_executor(_blocking, fn, *args)
+
+
+async def run_hashing_async(fn, *args):
+    """Асинхронный аналог password_hashing.run_hashing: тот же пул и те же ограничения."""
+    future = hashing_executor().submit(fn, *args)
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), HASH_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HashingBusy()
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str, headers=()):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = list(headers)
+
+
+class Request:
+    def __init__(self, scope, receive):
+        self.scope = scope
+        self.method = scope["method"]
+        self.path = scope["path"]
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True)
+        self.args = {k: v[-1] for k, v in query.items()}
+        self.headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+        self.sid = None
+        self.session = None
+        self._receive = receive
+
+    def arg_int(self, name, default=None):
+        try:
+            return int(self.args[name])
+        except (KeyError, ValueError):
+            return default
+
+    def cookie(self, name):
+        cookies = SimpleCookie()
+        try:
+            cookies.load(self.headers.get("cookie", ""))
+        except CookieError:
+            return None
+        morsel = cookies.get(name)
+        return morsel.value if morsel else None
+
+    async def body(self) -> bytes:
+        chunks = []
+        size = 0
+        while True:
+            message = await self._receive()
+            if message["type"] == "http.disconnect":
+                raise HTTPError(400, "Соединение закрыто клиентом")
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > MAX_BODY:
+                raise HTTPError(413, "Слишком большой запрос")
+            chunks.append(chunk)
+            if not message.get("more_body"):
+                return b"".join(chunks)
+
+    async def wait_disconnect(self):
+        """Ждет, пока клиент закроет соединение (для долгих потоков вроде SSE)."""
+        while (await self._receive())["type"] != "http.disconnect":
+            pass
+
+    async def data(self) -> dict:
+        """Тело запроса как словарь: JSON-объект или форма x-www-form-urlencoded."""
+        body = await self.body()
+        if "application/x-www-form-urlencoded" in self.headers.get("content-type", ""):
+            return {k: v[-1] for k, v in parse_qs(body.decode(), keep_blank_values=True).items()}
+        try:
+            data = json.loads(body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "Некорректный JSON")
+        if not isinstance(data, dict):
+            raise HTTPError(400, "Ожидается JSON-объект")
+        return data
+
+    def user(self) -> dict:
+        if not self.session or "username" not in self.session:
+            raise HTTPError(401, "Требуется вход")
+        return self.session
+
+
+class Response:
+    def __init__(self, payload=None, status=200, headers=(), stream=None,
+                 content_type="application/json; charset=utf-8"):
+        self.payload = payload
+        self.status = status
+        self.headers = list(headers)
+        self.stream = stream
+        self.content_type = content_type
+
+    async def send(self, send):
+        headers = [(k.encode("latin-1"), v.encode("latin-1")) for k, v in self.headers]
+        if self.status == 304:
+            await send({"type": "http.response.start", "status": 304, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        headers.insert(0, (b"content-type", self.content_type.encode()))
+        if self.stream is None:
+            body = json.dumps(self.payload, ensure_ascii=False).encode()
+            headers.append((b"content-length", str(len(body)).encode()))
+            await send({"type": "http.response.start", "status": self.status, "headers": headers})
+            await send({"type": "http.response.body", "body": body})
+            return
+        await send({"type": "http.response.start", "status": self.status, "headers": headers})
+        async for chunk in self.stream:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    # Слабое сравнение (RFC 9110): префикс W/ не учитывается
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or etag in (t[2:] if t.startswith("W/") else t for t in tags)
+
+
+async def conditional(req: Request, scope: str, *parts, build):
+    """Ответ с ETag по счетчику изменений scope; при совпадении If-None-Match — 304 без build().
+
+    build(version) строит тело по тому же номеру, что и ETag (см. web_app.conditional_response).
+    """
+    version = await run_blocking(get_change_version, scope)
+    etag = '"%s"' % version_etag(scope, version, *parts)
+    headers = [("etag", etag), ("cache-control", "private, no-cache")]
+    if _etag_matches(req.headers.get("if-none-match", ""), etag):
+        return Response(status=304, headers=headers)
+    response = await build(version)
+    response.headers += headers
+    return response
+
+
+def _session_cookie(req: Request, sid: str, max_age: int = None) -> tuple:
+    value = f"{SESSION_COOKIE}={sid}; Path=/; HttpOnly; SameSite=Lax"
+    if max_age is not None:
+        value += f"; Max-Age={max_age}"
+    if req.scope.get("scheme") == "https":
+        value += "; Secure"
+    return ("set-cookie", value)
+
+
+# --- ОБРАБОТЧИКИ ---
+
+async def api_test(req):
+    return Response({"test": True})
+
+
+async def api_login(req):
+    data = await req.data()
+    username = data.get("username", "")
+    password = data.get("password", "")
+    try:
+        user = await run_hashing_async(check_user, username, password)
+    except HashingBusy:
+        raise HTTPError(503, "Сервер перегружен, повторите попытку через несколько секунд", [("retry-after", "2")])
+    if not user:
+        raise HTTPError(401, "Неверное имя пользователя или пароль")
+
+    if req.sid:
+        await run_blocking(sessions.delete, req.sid)
+    sid = new_session_id()
+    await run_blocking(sessions.save, sid, {"username": user[0], "master_key": user[1]})
+    return Response({"success": True, "username": user[0]}, headers=[_session_cookie(req, sid)])
+
+
+async def api_logout(req):
+    if req.sid:
+        await run_blocking(sessions.delete, req.sid)
+    return Response({"success": True}, headers=[_session_cookie(req, "", max_age=0)])
+
+
+async def api_wallets(req):
+    user = req.user()
+    name_filter = req.args.get("name_filter", "")
+    master_key = req.args.get("master_key", user["master_key"])
+    scope = wallets_scope(wallet_owner_id(master_key or ""))
+    if "since" in req.args:
+        since = req.arg_int("since", 0)
+
+        async def changes(version):
+            return Response(await run_blocking(wallet_changes, master_key, since, version))
+        return await conditional(req, scope, "since", since, build=changes)
+
+    ndjson = req.args.get("format") == "ndjson" or \
+        req.headers.get("accept", "").startswith("application/x-ndjson")
+
+    async def listing(version):
+        return await _wallets_listing(req, name_filter, master_key, ndjson, version)
+    parts = [req.args.get(k, "") for k in ("limit", "after", "format")]
+    return await conditional(req, scope, name_filter, *parts, ndjson, build=listing)
+
+
+async def _wallets_listing(req, name_filter, master_key, ndjson, version=None):
+    mk_name = master_key[:4] if master_key else ""
+    after = req.arg_int("after", 0)
+    limit = req.arg_int("limit")
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+    wallets = iter_wallets(name_filter, mk_name, master_key, after_id=after, limit=limit, version=version)
+
+    if ndjson:
+        async def generate():
+            # Генератор не держит соединение между пачками, поэтому его можно
+            # продвигать из разных потоков пула
+            while True:
+                batch = await run_blocking(lambda: list(islice(wallets, SCAN_BATCH)))
+                if not batch:
+                    return
+                yield "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in batch).encode()
+        return Response(stream=generate(), content_type="application/x-ndjson")
+
+    items = await run_blocking(list, wallets)
+    if limit is None:
+        return Response(items)
+    next_after = items[-1]["id"] if len(items) == limit else None
+    return Response({"items": items, "next_after": next_after})
+
+
+async def api_create_wallet(req):
+    user = req.user()
+    data = await req.data()
+    master_key = data.get("master_key", user["master_key"])
+    fields = [data.get(f) for f in ("name", "login", "password", "host")]
+    if await run_blocking(add_wallet, *fields, master_key):
+        return Response({"success": True, "message": "Кошелек создан"})
+    return Response({"success": False, "message": "Ошибка создания кошелька"}, status=400)
+
+
+async def api_wallet_secret(req, wallet_id):
+    user = req.user()
+    params = await req.data() if req.method == "POST" else req.args
+    master_key = params.get("master_key", user["master_key"])
+    secret = await run_blocking(get_wallet_secret, wallet_id, master_key)
+    if secret is None:
+        raise HTTPError(404, "Кошелек не найден")
+    return Response(secret, headers=[("cache-control", "no-store")])
+
+
+async def api_wallet_changes(req):
+    user = req.user()
+    params = await req.data() if req.method == "POST" else req.args
+    master_key = params.get("master_key", user["master_key"])
+    try:
+        since = int(params.get("since", 0))
+    except (TypeError, ValueError):
+        since = 0
+
+    async def changes(version=None):
+        return Response(await run_blocking(wallet_changes, master_key, since, version))
+    if req.method == "GET":
+        return await conditional(req, wallets_scope(wallet_owner_id(master_key or "")), "since", since, build=changes)
+    return await changes()
+
+
+async def api_get_requests(req):
+    username = req.user()["username"]
+    scope = requests_scope(username)
+    if "since" in req.args:
+        since = req.arg_int("since", 0)
+
+        async def changes(version):
+            return Response(await run_blocking(request_changes, username, since, version))
+        return await conditional(req, scope, "since", since, build=changes)
+
+    status = req.args.get("status") or None
+    if status is not None and status not in REQUEST_STATUSES:
+        raise HTTPError(400, "Неизвестный статус запроса")
+    after = req.arg_int("after", 0)
+    limit = req.arg_int("limit")
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+    archived = req.args.get("archived") in ("1", "true")
+
+    async def listing(version):
+        items = await run_blocking(lambda: get_received_requests(
+            username, status=status, after_id=after, limit=limit, archived=archived))
+        if limit is None:
+            return Response(items)
+        next_after = items[-1][0] if len(items) == limit else None
+        return Response({"items": items, "next_after": next_after})
+    return await conditional(req, scope, status, after, limit, archived, build=listing)
+
+
+async def api_send_request(req):
+    user = req.user()
+    wait = request_limiter.acquire(user["username"])
+    if wait:
+        raise HTTPError(429, "Слишком много запросов, повторите попытку позже", [("retry-after", retry_after(wait))])
+    data = await req.data()
+    target_username = data.get("target_username")
+    if target_username == user["username"]:
+        return Response({"success": False, "message": "Нельзя отправить запрос самому себе"}, status=400)
+    result = await run_blocking(send_master_key_request, user["username"], target_username)
+    if result == REQUEST_ALREADY_PENDING:
+        return Response({"success": False, "message": "Запрос уже ожидает ответа"}, status=409)
+    if result:
+        return Response({"success": True, "message": "Запрос отправлен"})
+    return Response({"success": False, "message": "Пользователь не найден"}, status=400)
+
+
+async def api_request_events(req):
+    """Поток SSE о входящих запросах; то же поведение, что у web_app.change_events."""
+    scope = requests_scope(req.user()["username"])
+    try:
+        last_version = int(req.headers["last-event-id"])
+    except (KeyError, ValueError):
+        last_version = None
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue(QUEUE_SIZE)
+
+    def offer(event):
+        if not events.full():
+            events.put_nowait(event)
+
+    async def generate():
+        # Соединение ждет событий без потока: слушатель шины переносит их в цикл событий
+        unsubscribe = subscribe(scope, lambda event: loop.call_soon_threadsafe(offer, event))
+        disconnected = asyncio.ensure_future(req.wait_disconnect())
+        try:
+            version = await run_blocking(get_change_version, scope)
+            yield b"retry: 3000\n\n"
+            if last_version is not None and last_version != version:
+                yield sse_message({"version": version}, event="change", event_id=version).encode()
+            while True:
+                getter = asyncio.ensure_future(events.get())
+                done, _ = await asyncio.wait({getter, disconnected}, timeout=KEEPALIVE,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if disconnected in done:
+                    getter.cancel()
+                    return
+                if getter in done:
+                    event = getter.result()
+                else:
+                    getter.cancel()
+                    current = await run_blocking(get_change_version, scope)
+                    if current == version:
+                        yield b": keep-alive\n\n"
+                        continue
+                    event = {"version": current}
+                if event["version"] <= version:
+                    continue
+                version = event["version"]
+                yield sse_message(event, event="change", event_id=version).encode()
+        finally:
+            unsubscribe()
+            disconnected.cancel()
+
+    return Response(stream=generate(), content_type="text/event-stream",
+                    headers=[("cache-control", "no-cache")])
+
+
+async def api_respond_request(req, request_id):
+    user = req.user()
+    data = await req.data()
+    # Чужие запросы неотличимы от несуществующих
+    if not await run_blocking(respond_to_request, request_id, data.get("accept", False), user["username"]):
+        raise HTTPError(404, "Запрос не найден")
+    return Response({"success": True, "message": "Запрос обработан"})
+
+
+ROUTES = {
+    ("GET", "/api/test"): api_test,
+    ("POST", "/api/login"): api_login,
+    ("POST", "/api/logout"): api_logout,
+    ("GET", "/api/wallets"): api_wallets,
+    ("POST", "/api/wallets"): api_create_wallet,
+    ("GET", "/api/wallets/changes"): api_wallet_changes,
+    ("POST", "/api/wallets/changes"): api_wallet_changes,
+    ("GET", "/api/requests"): api_get_requests,
+    ("POST", "/api/requests"): api_send_request,
+    ("GET", "/api/requests/events"): api_request_events,
+}
+
+
+def resolve(method: str, path: str):
+    """Возвращает (обработчик, аргументы) или бросает HTTPError 404/405."""
+    handler = ROUTES.get((method, path))
+    if handler:
+        return handler, ()
+    prefix = "/api/requests/"
+    if path.startswith(prefix) and path[len(prefix):].isdigit():
+        if method != "POST":
+            raise HTTPError(405, "Метод не поддерживается")
+        return api_respond_request, (int(path[len(prefix):]),)
+    prefix, suffix = "/api/wallets/", "/secret"
+    if path.startswith(prefix) and path.endswith(suffix) and path[len(prefix):-len(suffix)].isdigit():
+        if method not in ("GET", "POST"):
+            raise HTTPError(405, "Метод не поддерживается")
+        return api_wallet_secret, (int(path[len(prefix):-len(suffix)]),)
+    if any(p == path for _, p in ROUTES):
+        raise HTTPError(405, "Метод не поддерживается")
+    raise HTTPError(404, "Не найдено")
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await run_blocking(init)
+            except Exception as e:
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            _blocking.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    req = Request(scope, receive)
+    try:
+        handler, args = resolve(req.method, req.path)
+        req.sid = req.cookie(SESSION_COOKIE)
+        if req.sid:
+            req.session = await run_blocking(sessions.get, req.sid)
+            if req.session is None:
+                req.sid = None
+        response = await handler(req, *args)
+    except HTTPError as e:
+        response = Response({"success": False, "message": e.message}, status=e.status, headers=e.headers)
+    await response.send(send)
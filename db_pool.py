@@ -0,0 +1,119 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+# Настройки соединения. cache_size задается в КиБ (отрицательное значение),
+# mmap_size — в байтах. Значения подобраны под небольшую БД users.db.
+PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("cache_size", -16000),
+    ("mmap_size", 64 * 1024 * 1024),
+    ("temp_store", "MEMORY"),
+    ("foreign_keys", "ON"),
+)
+
+
+class ConnectionPool:
+    """Пул соединений SQLite с привязкой соединения к потоку на время работы.
+
+    - Поток получает соединение при входе в ``connection()`` и возвращает его
+      в пул при выходе из самого внешнего блока, поэтому вложенные вызовы
+      используют одно и то же соединение и одну транзакцию.
+    - Простаивающие соединения переиспользуются между потоками (Flask с
+      ``threaded=True`` создает поток на каждый запрос), лишние закрываются.
+    - После fork (воркеры gunicorn) унаследованные от родителя соединения не
+      используются: SQLite запрещает переносить открытое соединение в дочерний
+      процесс, поэтому пул начинает заново.
+    """
+
+    def __init__(self, path: str, max_idle: int = 8, timeout: float = 30.0):
+        self.path = path
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            # Соединения родителя не закрываем в дочернем процессе, а только
+            # держим ссылку, чтобы сборщик мусора не закрыл их за нас
+            self._inherited = self._idle
+            self._idle = queue.LifoQueue()
+            self._local = threading.local()
+            self._pid = os.getpid()
+
+    def _open(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+        for name, value in PRAGMAS:
+            conn.execute(f"PRAGMA {name}={value}")
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._open()
+
+    def _release(self, conn: sqlite3.Connection):
+        with self._lock:
+            if self._idle.qsize() < self.max_idle:
+                self._idle.put_nowait(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        """Выдает соединение текущего потока.
+
+        Самый внешний блок фиксирует транзакцию при успешном выходе и
+        откатывает ее при исключении.
+        """
+        self._check_fork()
+        local = self._local
+        depth = getattr(local, "depth", 0)
+        if depth == 0:
+            local.conn = self._acquire()
+        local.depth = depth + 1
+        conn = local.conn
+        try:
+            yield conn
+            if depth == 0:
+                conn.commit()
+        except BaseException:
+            if depth == 0:
+                conn.rollback()
+            raise
+        finally:
+            local.depth = depth
+            if depth == 0:
+                local.conn = None
+                self._release(conn)
+
+    def close_all(self):
+        """Закрывает все простаивающие соединения пула."""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path: str) -> ConnectionPool:
+    """Возвращает общий пул для файла БД (один пул на путь в процессе)."""
+    key = os.path.abspath(path)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(key)
+        return pool
@@ -0,0 +1,115 @@
+"""
+Публикация событий внутри процесса (pub/sub).
+
+init_db публикует событие после фиксации изменения (например, нового
+запроса на мастер-ключ) в тему с тем же именем, что и счетчик изменений
+(requests_scope(username)). Подписчики — потоки ответов SSE веб-версии,
+ASGI-приложение и окна GUI — получают его сразу, без опроса БД.
+
+Событие — только уведомление: получатель догружает изменения по since=N,
+поэтому потерянное при переполнении очереди событие ничего не ломает.
+Шина видит только события своего процесса; изменения из других процессов
+(воркеров gunicorn) подписчики замечают по счетчику изменений, который
+сверяют раз в KEEPALIVE секунд.
+"""
+
+import json
+import logging
+import os
+import queue
+import threading
+
+
+# Раз в сколько секунд поток событий шлет keep-alive и сверяет счетчик изменений
+KEEPALIVE = float(os.environ.get("KS_EVENTS_KEEPALIVE", "15"))
+# Сколько непрочитанных событий держать на одного подписчика
+QUEUE_SIZE = int(os.environ.get("KS_EVENTS_QUEUE", "100"))
+
+
+class EventBus:
+    """Темы и их подписчики; listener(event) вызывается в потоке публикующего."""
+
+    def __init__(self):
+        self._listeners = {}  # тема -> список слушателей
+        self._lock = threading.Lock()
+
+    def subscribe(self, topic: str, listener):
+        """Подписывает listener на тему и возвращает функцию отписки."""
+        with self._lock:
+            self._listeners.setdefault(topic, []).append(listener)
+
+        def unsubscribe():
+            with self._lock:
+                listeners = self._listeners.get(topic)
+                if listeners and listener in listeners:
+                    listeners.remove(listener)
+                    if not listeners:
+                        del self._listeners[topic]
+        return unsubscribe
+
+    def publish(self, topic: str, event: dict):
+        with self._lock:
+            listeners = list(self._listeners.get(topic, ()))
+        for listener in listeners:
+            try:
+                listener(event)
+            except Exception:
+                logging.exception("Ошибка подписчика события %s", topic)
+
+    def listen(self, topic: str, maxsize: int = QUEUE_SIZE) -> "Subscription":
+        return Subscription(self, topic, maxsize)
+
+    def subscribers(self, topic: str) -> int:
+        with self._lock:
+            return len(self._listeners.get(topic, ()))
+
+
+class Subscription:
+    """Очередь событий темы для одного потока-потребителя (например, ответа SSE).
+
+    Используется как контекстный менеджер: при выходе подписка снимается.
+    """
+
+    def __init__(self, bus: EventBus, topic: str, maxsize: int = QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize)
+        self._unsubscribe = bus.subscribe(topic, self._offer)
+
+    def _offer(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            pass  # в очереди уже есть уведомления, получатель все равно догрузит изменения
+
+    def get(self, timeout: float = None):
+        """Следующее событие или None, если за timeout секунд событий не было."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self._unsubscribe()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def sse_message(data: dict, event: str = None, event_id=None) -> str:
+    """Сообщение в формате text/event-stream."""
+    lines = []
+    if event:
+        lines.append(f"event: {event}")
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append("data: " + json.dumps(data, ensure_ascii=False))
+    return "\n".join(lines) + "\n\n"
+
+
+# Общая шина процесса
+bus = EventBus()
+subscribe = bus.subscribe
+publish = bus.publish
+listen = bus.listen
@@ -0,0 +1,131 @@
+"""
+Фоновые задачи десктопного интерфейса.
+
+Обращения к БД, bcrypt и расшифровка выполняются в пуле потоков, а их
+результаты передаются обратно в поток Tk через очередь, которую главный
+цикл опрашивает с помощью after(). Виджеты Tk трогаются только из
+обработчиков on_done/on_error, то есть всегда из главного потока.
+"""
+
+import logging
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+
+GUI_WORKERS = int(os.environ.get("KS_GUI_WORKERS", "2"))
+
+
+class TaskRunner:
+    """Пул фоновых задач, результаты которых доставляются в поток Tk.
+
+    root — любой виджет Tk (нужен только его after()). Задачи одного
+    канала (channel) вытесняют друг друга: новая задача отменяет еще не
+    начатую предыдущую, а результат уже выполняющейся просто не
+    доставляется — так поиск при повторном нажатии показывает только
+    последний результат.
+    """
+
+    POLL_MS = 30
+
+    def __init__(self, root, max_workers: int = GUI_WORKERS):
+        self.root = root
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ks-gui")
+        self._results = queue.SimpleQueue()
+        self._pending = 0
+        self._polling = False
+        self._closed = False
+        self._generations = {}  # канал -> номер последней задачи
+        self._futures = {}      # канал -> future последней задачи
+        self._busy = {}         # канал -> индикатор последней задачи
+
+    def submit(self, fn, *args, on_done=None, on_error=None, channel=None, busy=None, owner=None):
+        """Выполняет fn(*args) в пуле.
+
+        on_done(result) или on_error(exc) вызываются в потоке Tk; если owner
+        (окно) к этому времени закрыто, результат отбрасывается. busy(True)
+        вызывается сразу, busy(False) — когда задача завершена или вытеснена.
+        """
+        if self._closed:
+            return None
+        generation = None
+        if channel is not None:
+            self.cancel(channel)
+            generation = self._generations[channel] = self._generations.get(channel, 0) + 1
+            if busy:
+                self._busy[channel] = busy
+        if busy:
+            busy(True)
+
+        future = self._executor.submit(fn, *args)
+        self._pending += 1
+        if channel is not None:
+            self._futures[channel] = future
+        future.add_done_callback(
+            lambda f: self._results.put((f, on_done, on_error, channel, generation, busy, owner))
+        )
+        self._schedule()
+        return future
+
+    def cancel(self, channel):
+        """Отменяет последнюю задачу канала: ее результат не будет доставлен."""
+        future = self._futures.pop(channel, None)
+        if future is None:
+            return
+        future.cancel()
+        self._generations[channel] = self._generations.get(channel, 0) + 1
+        busy = self._busy.pop(channel, None)
+        if busy:
+            self._call(busy, False)
+
+    def shutdown(self):
+        self._closed = True
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _schedule(self):
+        if not self._polling and not self._closed:
+            self._polling = True
+            self.root.after(self.POLL_MS, self._poll)
+
+    def _poll(self):
+        self._polling = False
+        while True:
+            try:
+                item = self._results.get_nowait()
+            except queue.Empty:
+                break
+            self._pending -= 1
+            self._deliver(*item)
+        if self._pending:
+            self._schedule()
+
+    def _deliver(self, future, on_done, on_error, channel, generation, busy, owner):
+        if channel is not None:
+            if self._generations.get(channel) != generation:
+                return  # вытеснена более новой задачей или отменена
+            self._futures.pop(channel, None)
+            self._busy.pop(channel, None)
+        if future.cancelled():
+            return
+        if owner is not None and not self._call(owner.winfo_exists):
+            return
+        if busy:
+            self._call(busy, False)
+
+        error = future.exception()
+        if error is None:
+            if on_done:
+                self._call(on_done, future.result())
+        elif on_error:
+            self._call(on_error, error)
+        else:
+            logging.error("Фоновая задача завершилась с ошибкой", exc_info=error)
+
+    @staticmethod
+    def _call(fn, *args):
+        # Окно могло быть закрыто, пока задача выполнялась, — это не ошибка приложения
+        try:
+            return fn(*args)
+        except Exception:
+            logging.exception("Ошибка при обработке результата фоновой задачи")
+            return None
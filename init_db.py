@@ -1,10 +1,21 @@
 import sqlite3
 import secrets
 import hashlib
+import hmac
 import base64
 from cryptography.fernet import Fernet, InvalidToken
-import bcrypt
+import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from db_pool import get_pool
+from key_cache import KeyCache
+from vault_cache import VaultCache
+from migrations import apply_migrations
+from events import publish
+from password_hashing import hash_password, verify_password, needs_rehash
 
 def _resolve_db_path() -> str:
     """Возвращает абсолютный путь к users.db, корректный и при запуске из .py, и из PyInstaller .exe.
@@ -19,45 +30,88 @@ def _resolve_db_path() -> str:
 DB_NAME = _resolve_db_path()
 
 
+_schema_lock = threading.Lock()
+_schema_ready = False
 
-def create_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE NOT NULL,
-        password TEXT NOT NULL,
-        master_key TEXT UNIQUE NOT NULL
-    )
-    ''')
-    conn.commit()
-    conn.close()
-
-
-def create_wallets_table():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS wallets (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        login TEXT NOT NULL,
-        password TEXT NOT NULL,
-        host TEXT NOT NULL,
-        mk_name TEXT NOT NULL
-    )
-    ''')
-    conn.commit()
-    conn.close()
 
+def init():
+    """Готовит БД к работе: применяет миграции схемы (см. migrations.py).
+
+    Импорт модуля больше не трогает БД: init() вызывается явно при старте
+    или автоматически при первом обращении через db_connection().
+    Повторные вызовы ничего не делают.
+    """
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        with get_pool(DB_NAME).connection() as conn:
+            apply_migrations(conn)
+        _schema_ready = True
 
 
-def get_fernet_key(master_key: str) -> Fernet:
+def db_connection():
+    """Контекстный менеджер с соединением из общего пула для DB_NAME."""
+    init()
+    return get_pool(DB_NAME).connection()
+
+
+# Старые точки входа: таблицы теперь создаются миграциями
+create_db = init
+create_wallets_table = init
+create_requests_table = init
+
+
+# Кэш объектов Fernet: ключ выводится один раз на мастер-ключ, а не на каждое поле.
+# Размер и время жизни настраиваются переменными окружения.
+_fernet_cache = KeyCache(
+    max_size=int(os.environ.get("KS_KEY_CACHE_SIZE", "128")),
+    ttl=float(os.environ.get("KS_KEY_CACHE_TTL", "900")),
+)
+
+
+# Кэш расшифрованных хранилищ по owner_id: повторный поиск и фильтрация
+# выполняются в памяти. Ограничен суммарным числом записей и временем жизни.
+_vault_cache = VaultCache(
+    max_rows=int(os.environ.get("KS_VAULT_CACHE_ROWS", "20000")),
+    ttl=float(os.environ.get("KS_VAULT_CACHE_TTL", "300")),
+)
+
+
+def _derive_fernet(master_key: str) -> Fernet:
     digest = hashlib.sha256(master_key.encode()).digest()
     return Fernet(base64.urlsafe_b64encode(digest))
 
 
+def get_fernet_key(master_key: str) -> Fernet:
+    return _fernet_cache.get_or_create(master_key, lambda: _derive_fernet(master_key))
+
+
+def forget_master_key(master_key: str):
+    """Удаляет из памяти производные ключи и расшифрованное хранилище master_key (вызывается при выходе)."""
+    if master_key:
+        _fernet_cache.forget(master_key)
+        _vault_cache.invalidate(wallet_owner_id(master_key))
+
+
+def key_cache_stats() -> dict:
+    """Счетчики попаданий/промахов кэша ключей."""
+    return _fernet_cache.stats()
+
+
+def vault_cache_stats() -> dict:
+    """Счетчики кэша расшифрованных хранилищ."""
+    return _vault_cache.stats()
+
+
+def invalidate_vaults(owner_ids):
+    """Сбрасывает кэш хранилищ владельцев; вызывать после фиксации записи в wallets."""
+    for owner_id in set(owner_ids):
+        _vault_cache.invalidate(owner_id)
+
+
 def encrypt_data(data: str, master_key: str) -> str:
     f = get_fernet_key(master_key)
     return f.encrypt(data.encode()).decode()
@@ -74,188 +128,761 @@ def generate_master_key():
 
 
 def add_user(username, password):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
     master_key = generate_master_key()
 
-    hashed = bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode()
+    hashed = hash_password(password)
 
     try:
-        cursor.execute(
-            "INSERT INTO users (username, password, master_key) VALUES (?, ?, ?)",
-            (username, hashed, master_key)
-        )
-        conn.commit()
+        with db_connection() as conn:
+            conn.execute(
+                "INSERT INTO users (username, password, master_key) VALUES (?, ?, ?)",
+                (username, hashed, master_key)
+            )
         return True
     except sqlite3.IntegrityError:
         return False
-    finally:
-        conn.close()
 
 
 def check_user(username, password):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT username, password, master_key FROM users WHERE username=?",
-        (username,)
-    )
-    row = cursor.fetchone()
-    conn.close()
-
-    if row and bcrypt.checkpw(password.encode(), row[1].encode()):
+    with db_connection() as conn:
+        row = conn.execute(
+            "SELECT username, password, master_key FROM users WHERE username=?",
+            (username,)
+        ).fetchone()
+
+    if row and verify_password(password, row[1]):
+        if needs_rehash(row[1]):
+            # Пароль известен только сейчас — переводим хеш на текущую стоимость.
+            # Условие на старый хеш не даст затереть параллельную смену пароля.
+            with db_connection() as conn:
+                conn.execute(
+                    "UPDATE users SET password=? WHERE username=? AND password=?",
+                    (hash_password(password), row[0], row[1])
+                )
         return (row[0], row[2])
     return None
 
 
 
-def create_requests_table():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS master_key_requests (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        from_user TEXT NOT NULL,
-        to_user TEXT NOT NULL,
-        status TEXT NOT NULL DEFAULT 'pending'
+# Счетчики изменений (таблица change_versions): по ним клиенты узнают,
+# изменилось ли что-то с прошлого запроса, не читая и не расшифровывая данные.
+
+def wallets_scope(owner_id: str) -> str:
+    """Имя счетчика изменений хранилища владельца owner_id."""
+    return f"wallets:{owner_id}"
+
+
+def requests_scope(username: str) -> str:
+    """Имя счетчика изменений входящих запросов пользователя username."""
+    return f"requests:{username}"
+
+
+def bump_change_version(conn, scope: str, reset: bool = False) -> int:
+    """Увеличивает счетчик изменений scope в текущей транзакции и возвращает новое значение.
+
+    reset=True — изменение удалило записи: клиенты с since= меньше нового
+    номера получат весь список, а не только записи с changed > since.
+    """
+    conn.execute(
+        "INSERT INTO change_versions (scope, version) VALUES (?, 1) "
+        "ON CONFLICT(scope) DO UPDATE SET version=version+1",
+        (scope,)
     )
-    ''')
-    conn.commit()
-    conn.close()
+    if reset:
+        conn.execute("UPDATE change_versions SET reset=version WHERE scope=?", (scope,))
+    return conn.execute("SELECT version FROM change_versions WHERE scope=?", (scope,)).fetchone()[0]
+
+
+def get_change_version(scope: str) -> int:
+    """Номер последнего изменения scope (0 — изменений еще не было)."""
+    with db_connection() as conn:
+        row = conn.execute("SELECT version FROM change_versions WHERE scope=?", (scope,)).fetchone()
+    return row[0] if row else 0
+
+
+def version_etag(scope: str, version: int, *parts) -> str:
+    """Значение ETag для ответа, зависящего от счетчика scope и параметров запроса parts."""
+    key = "\x1f".join(str(p) for p in (scope, version) + parts)
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+REQUEST_SENT = "sent"
+REQUEST_ALREADY_PENDING = "pending"
 
 
 def send_master_key_request(from_user, to_user):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT username FROM users WHERE username=?", (to_user,))
-    if not cursor.fetchone():
-        conn.close()
-        return False
-    cursor.execute(
-        "INSERT INTO master_key_requests (from_user, to_user, status) VALUES (?, ?, 'pending')",
-        (from_user, to_user)
-    )
-    conn.commit()
-    conn.close()
-    return True
+    """Создает ожидающий запрос from_user -> to_user.
 
+    Возвращает REQUEST_SENT, если запрос создан, REQUEST_ALREADY_PENDING,
+    если предыдущий запрос этой пары еще ждет ответа (уникальный индекс по
+    ожидающим запросам — ничего не меняется), и False, если получателя нет.
+    """
+    with db_connection() as conn:
+        if not conn.execute("SELECT username FROM users WHERE username=?", (to_user,)).fetchone():
+            return False
+        cursor = conn.execute(
+            "INSERT INTO master_key_requests (from_user, to_user, status, created_at) VALUES (?, ?, 'pending', ?) "
+            "ON CONFLICT (from_user, to_user) WHERE status='pending' DO NOTHING",
+            (from_user, to_user, time.time())
+        )
+        if cursor.rowcount == 0:
+            return REQUEST_ALREADY_PENDING
+        request_id = cursor.lastrowid
+        changed = bump_change_version(conn, requests_scope(to_user))
+        conn.execute("UPDATE master_key_requests SET changed=? WHERE id=?", (changed, request_id))
+    publish(requests_scope(to_user), {"version": changed, "id": request_id, "from_user": from_user, "status": "pending"})
+    return REQUEST_SENT
 
-def get_received_requests(username):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT id, from_user, status FROM master_key_requests WHERE to_user=?",
-        (username,)
-    )
-    results = cursor.fetchall()
-    conn.close()
-    return results
 
+REQUEST_STATUSES = ("pending", "accepted", "rejected")
 
-def respond_to_request(request_id, accept):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+
+def get_received_requests(username, since: int = 0, status: str = None, after_id: int = 0, limit: int = None,
+                          archived: bool = False):
+    """Входящие запросы (id, from_user, status) в порядке id.
+
+    status — только запросы с этим статусом; after_id и limit задают
+    страницу (курсор — id последнего запроса предыдущей страницы); since —
+    только измененные после этого номера. archived=True читает архив
+    обработанных запросов (см. archive_requests).
+    """
+    table = "master_key_requests_archive" if archived else "master_key_requests"
+    query = f"SELECT id, from_user, status FROM {table} WHERE to_user=?"
+    params = [username]
+    if status:
+        query += " AND status=?"
+        params.append(status)
+    if since:
+        query += " AND changed>?"
+        params.append(since)
+    if after_id:
+        query += " AND id>?"
+        params.append(after_id)
+    query += " ORDER BY id"
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    with db_connection() as conn:
+        return conn.execute(query, params).fetchall()
+
+
+def request_changes(username, since: int = 0, version: int = None) -> dict:
+    """Изменения входящих запросов после номера since, по аналогии с wallet_changes.
+
+    Если после since запросы удалялись (архивация), весь список отдается
+    заново (full=True) — иначе клиент продолжал бы показывать удаленные.
+    Клиент с актуальной версией (в том числе 0 при пустом списке) получает
+    пустой ответ без full.
+    """
+    with db_connection() as conn:
+        row = conn.execute("SELECT version, reset FROM change_versions WHERE scope=?",
+                           (requests_scope(username),)).fetchone()
+    current, reset = row or (0, 0)
+    if version is None:
+        version = current
+    if since == version and since >= reset:
+        return {"version": version, "full": False, "items": []}
+    if since <= 0 or since > version or since < reset:
+        return {"version": version, "full": True, "items": get_received_requests(username)}
+    return {"version": version, "full": False, "items": get_received_requests(username, since)}
+
+
+def respond_to_request(request_id, accept, username):
+    """Принимает или отклоняет запрос, адресованный username.
+
+    Возвращает False, если запроса нет или он адресован другому пользователю.
+    """
     status = 'accepted' if accept else 'rejected'
-    cursor.execute(
-        "UPDATE master_key_requests SET status=? WHERE id=?",
-        (status, request_id)
-    )
-    conn.commit()
-    conn.close()
-
-
-def get_shared_master_keys(username):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute('''
-    SELECT u.username, u.master_key, r.status
-    FROM master_key_requests r
-    JOIN users u ON r.to_user = u.username
-    WHERE r.from_user = ?
-    ''', (username,))
-    rows = cursor.fetchall()
-    conn.close()
+    with db_connection() as conn:
+        row = conn.execute(
+            "SELECT to_user, from_user FROM master_key_requests WHERE id=? AND to_user=?",
+            (request_id, username)
+        ).fetchone()
+        if row is None:
+            return False
+        changed = bump_change_version(conn, requests_scope(row[0]))
+        conn.execute(
+            "UPDATE master_key_requests SET status=?, changed=?, resolved_at=? WHERE id=?",
+            (status, changed, time.time(), request_id)
+        )
+    publish(requests_scope(row[0]), {"version": changed, "id": int(request_id), "from_user": row[1], "status": status})
+    return True
+
+
+def get_shared_master_keys(username, after_id: int = 0, limit: int = None):
+    """Исходящие запросы (to_user, master_key, status, id) в порядке id.
+
+    after_id и limit задают страницу, как в get_received_requests: курсор —
+    id последнего запроса предыдущей страницы. Архив сохраняет id запросов,
+    поэтому курсор общий для обеих таблиц.
+    """
+    # Из архива берутся только принятые запросы: доступ к ключу после
+    # архивации сохраняется, а история отказов больше не показывается
+    query = '''
+        SELECT u.username, u.master_key, r.status, r.id
+        FROM master_key_requests r
+        JOIN users u ON r.to_user = u.username
+        WHERE r.from_user = ? AND r.id > ?
+        UNION ALL
+        SELECT u.username, u.master_key, a.status, a.id
+        FROM master_key_requests_archive a
+        JOIN users u ON a.to_user = u.username
+        WHERE a.from_user = ? AND a.status = 'accepted' AND a.id > ?
+        ORDER BY 4
+    '''
+    params = [username, after_id, username, after_id]
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    with db_connection() as conn:
+        rows = conn.execute(query, params).fetchall()
 
     # Безопасность: не возвращаем значение мастер-ключа до одобрения
     sanitized = []
     for row in rows:
-        to_username, master_key, status = row
+        to_username, master_key, status, request_id = row
         visible_key = master_key if status == 'accepted' else None
-        sanitized.append((to_username, visible_key, status))
+        sanitized.append((to_username, visible_key, status, request_id))
     return sanitized
 
 
+# Обработанные запросы старше этого числа дней переносятся в архив
+REQUEST_ARCHIVE_DAYS = int(os.environ.get("KS_REQUEST_ARCHIVE_DAYS", "30"))
+
+
+def archive_requests(older_than_days: float = REQUEST_ARCHIVE_DAYS, batch_size: int = 500, progress=None) -> int:
+    """Переносит обработанные запросы старше older_than_days дней в master_key_requests_archive.
+
+    Ожидающие запросы не трогаются; обработанным до появления resolved_at
+    миграция проставила время миграции. Каждая пачка переносится отдельной
+    транзакцией, а счетчики изменений получателей увеличиваются с reset,
+    чтобы ETag их списков перестал совпадать, а клиенты since= перезагрузили
+    список. Возвращает число перенесенных запросов.
+    """
+    cutoff = time.time() - older_than_days * 86400
+    total = 0
+    while True:
+        with db_connection() as conn:
+            rows = conn.execute(
+                "SELECT id, to_user FROM master_key_requests "
+                "WHERE status IN ('accepted', 'rejected') AND resolved_at<? ORDER BY id LIMIT ?",
+                (cutoff, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            ids = [r[0] for r in rows]
+            placeholders = ",".join("?" * len(ids))
+            conn.execute(
+                "INSERT OR REPLACE INTO master_key_requests_archive "
+                "(id, from_user, to_user, status, changed, created_at, resolved_at, archived_at) "
+                "SELECT id, from_user, to_user, status, changed, created_at, resolved_at, ? "
+                f"FROM master_key_requests WHERE id IN ({placeholders})",
+                [time.time()] + ids
+            )
+            conn.execute(f"DELETE FROM master_key_requests WHERE id IN ({placeholders})", ids)
+            for to_user in {r[1] for r in rows}:
+                bump_change_version(conn, requests_scope(to_user), reset=True)
+        total += len(rows)
+        if progress:
+            progress(total)
+    return total
+
+
+RECORD_VERSION = 3
+WALLET_FIELDS = ("name", "login", "password", "host")
+# Формат 3 шифрует отдельно поля для списка (data) и секреты (secret),
+# поэтому список кошельков строится без расшифровки логинов и паролей
+DISPLAY_FIELDS = ("name", "host")
+SECRET_FIELDS = ("login", "password")
+
+
+def _seal_fields(fields: dict, keys, master_key: str) -> str:
+    payload = json.dumps({k: fields[k] for k in keys}, ensure_ascii=False, separators=(",", ":"))
+    return encrypt_data(payload, master_key)
+
+
+def encrypt_record(fields: dict, master_key: str) -> tuple:
+    """Шифрует кошелек в формате 3: (data, secret) — токены Fernet для DISPLAY_FIELDS и SECRET_FIELDS."""
+    return _seal_fields(fields, DISPLAY_FIELDS, master_key), _seal_fields(fields, SECRET_FIELDS, master_key)
+
+
+def decrypt_record(row, master_key: str, with_secrets: bool = True) -> dict:
+    """Расшифровывает строку (version, name, login, password, host, data, secret) любого формата.
+
+    Без with_secrets возвращаются только DISPLAY_FIELDS, а секреты по
+    возможности не расшифровываются вовсе. Бросает InvalidToken, если ключ не подходит.
+    """
+    version, name_enc, login_enc, pass_enc, host_enc, data, secret = row
+    if version >= 3:
+        fields = json.loads(decrypt_data(data, master_key))
+        if with_secrets:
+            fields.update(json.loads(decrypt_data(secret, master_key)))
+        return fields
+    if version == 2:
+        fields = json.loads(decrypt_data(data, master_key))
+        if not with_secrets:
+            fields = {k: fields[k] for k in DISPLAY_FIELDS}
+        return fields
+    fields = {
+        "name": decrypt_data(name_enc, master_key),
+        "host": decrypt_data(host_enc, master_key),
+    }
+    if with_secrets:
+        fields["login"] = decrypt_data(login_enc, master_key)
+        fields["password"] = decrypt_data(pass_enc, master_key)
+    return fields
+
+
+# Длина n-грамм слепого индекса. Имя индексируется всеми подстроками длиной
+# от 1 до NGRAM_SIZE, поэтому поиск по любой подстроке сводится к пересечению токенов.
+NGRAM_SIZE = 3
+
+
+def _name_index_key(master_key: str) -> bytes:
+    digest = hashlib.sha256(master_key.encode()).digest()
+    return hmac.new(digest, b"keysecret:name-index", hashlib.sha256).digest()
+
+
+def _name_token(index_key: bytes, gram: str) -> str:
+    return hmac.new(index_key, gram.encode(), hashlib.sha256).hexdigest()[:32]
+
+
+def name_index_tokens(name: str, master_key: str) -> set:
+    """Токены слепого индекса для названия кошелька."""
+    text = name.lower()
+    index_key = _name_index_key(master_key)
+    grams = {text[i:i + n] for n in range(1, NGRAM_SIZE + 1) for i in range(len(text) - n + 1)}
+    return {_name_token(index_key, g) for g in grams}
+
+
+def name_query_tokens(name_filter: str, master_key: str) -> set:
+    """Токены, которые обязаны присутствовать у кошелька, чье имя содержит name_filter."""
+    text = name_filter.lower()
+    index_key = _name_index_key(master_key)
+    if len(text) <= NGRAM_SIZE:
+        grams = {text}
+    else:
+        grams = {text[i:i + NGRAM_SIZE] for i in range(len(text) - NGRAM_SIZE + 1)}
+    return {_name_token(index_key, g) for g in grams}
+
+
+def _write_name_index(conn, wallet_id: int, name: str, master_key: str):
+    conn.execute("DELETE FROM wallet_name_tokens WHERE wallet_id=?", (wallet_id,))
+    conn.executemany(
+        "INSERT OR IGNORE INTO wallet_name_tokens (token, wallet_id) VALUES (?, ?)",
+        [(t, wallet_id) for t in name_index_tokens(name, master_key)]
+    )
+    conn.execute("UPDATE wallets SET name_indexed=1 WHERE id=?", (wallet_id,))
+
+
+def wallet_owner_id(master_key: str) -> str:
+    """Полноразмерный идентификатор владельца кошельков, выводимый из мастер-ключа.
+
+    В отличие от mk_name (первые 4 символа ключа) не дает коллизий между
+    пользователями и не раскрывает сам ключ.
+    """
+    digest = hashlib.sha256(master_key.encode()).digest()
+    return hmac.new(digest, b"keysecret:owner-id", hashlib.sha256).hexdigest()
+
+
+# Владельцы, старые кошельки которых (без owner_id) в этом процессе уже присвоены
+_claimed_owners = set()
+_claimed_owners_lock = threading.Lock()
+
+
+def claim_legacy_wallets(master_key: str, batch_size: int = 500) -> int:
+    """Назначает owner_id старым кошелькам владельца master_key, которым он еще не назначен.
+
+    Кандидаты — строки без owner_id с тем же mk_name (частичный индекс
+    idx_wallets_legacy_mk_name); свои отличаются тем, что расшифровываются
+    master_key, чужие остаются как есть. Новые строки всегда пишутся с
+    owner_id, поэтому проверка выполняется один раз на владельца в процессе,
+    а выборки кошельков идут только по owner_id, без OR по mk_name.
+    Возвращает число присвоенных строк.
+    """
+    owner_id = wallet_owner_id(master_key)
+    if owner_id in _claimed_owners:
+        return 0
+    claimed = 0
+    last_id = 0
+    while True:
+        with db_connection() as conn:
+            rows = conn.execute(
+                "SELECT id, version, name, login, password, host, data, secret FROM wallets "
+                "WHERE owner_id IS NULL AND mk_name=? AND id>? ORDER BY id LIMIT ?",
+                (master_key[:4], last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            mine = []
+            for r in rows:
+                try:
+                    decrypt_record(r[1:], master_key)
+                except (InvalidToken, ValueError):
+                    continue
+                mine.append(r[0])
+            if mine:
+                # Строки впервые попадают в выборку по owner_id — клиенты since= должны их получить
+                changed = bump_change_version(conn, wallets_scope(owner_id))
+                conn.executemany(
+                    "UPDATE wallets SET owner_id=?, changed=? WHERE id=?",
+                    [(owner_id, changed, wid) for wid in mine]
+                )
+                claimed += len(mine)
+    with _claimed_owners_lock:
+        _claimed_owners.add(owner_id)
+    return claimed
+
+
+def prepare_wallet(name, login, password, host, master_key) -> tuple:
+    """Шифрует кошелек и готовит его к вставке: (mk_name, data, secret, owner_id, tokens).
+
+    Вся криптография выполняется здесь, без обращения к БД, поэтому функцию
+    можно вызывать в отдельных процессах (см. wallet_import.py).
+    """
+    data, secret = encrypt_record({"name": name, "login": login, "password": password, "host": host}, master_key)
+    tokens = sorted(name_index_tokens(name, master_key))
+    return (master_key[:4], data, secret, wallet_owner_id(master_key), tokens)
+
+
+def insert_wallets(conn, prepared) -> list:
+    """Вставляет подготовленные prepare_wallet() кошельки через executemany и возвращает их id.
+
+    Транзакция открывается с блокировкой записи, поэтому id, выданные после
+    текущего максимума, принадлежат именно этой пачке. Счетчик изменений
+    каждого владельца увеличивается один раз на пачку, и ее записи получают
+    его новое значение в changed. После фиксации транзакции вызывающий
+    сбрасывает кэш владельцев через invalidate_vaults().
+    """
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    before = conn.execute("SELECT COALESCE(MAX(id), 0) FROM wallets").fetchone()[0]
+    versions = {owner_id: bump_change_version(conn, wallets_scope(owner_id)) for owner_id in {p[3] for p in prepared}}
+    conn.executemany(
+        "INSERT INTO wallets (name, login, password, host, mk_name, version, data, secret, owner_id, name_indexed, changed) "
+        f"VALUES ('', '', '', '', ?, {RECORD_VERSION}, ?, ?, ?, 1, ?)",
+        [(mk_name, data, secret, owner_id, versions[owner_id]) for mk_name, data, secret, owner_id, _ in prepared]
+    )
+    ids = [wid for (wid,) in conn.execute("SELECT id FROM wallets WHERE id>? ORDER BY id", (before,))]
+    conn.executemany(
+        "INSERT OR IGNORE INTO wallet_name_tokens (token, wallet_id) VALUES (?, ?)",
+        [(token, wid) for wid, p in zip(ids, prepared) for token in p[4]]
+    )
+    return ids
+
 
 def add_wallet(name, login, password, host, master_key):
-    mk_name = master_key[:4]
-    name_enc = encrypt_data(name, master_key)
-    login_enc = encrypt_data(login, master_key)
-    password_enc = encrypt_data(password, master_key)
-    host_enc = encrypt_data(host, master_key)
-
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    prepared = prepare_wallet(name, login, password, host, master_key)
+
     try:
-        cursor.execute(
-            "INSERT INTO wallets (name, login, password, host, mk_name) VALUES (?, ?, ?, ?, ?)",
-            (name_enc, login_enc, password_enc, host_enc, mk_name)
-        )
-        conn.commit()
-        return True
+        with db_connection() as conn:
+            insert_wallets(conn, [prepared])
     except sqlite3.IntegrityError:
         return False
-    finally:
-        conn.close()
+    invalidate_vaults([prepared[3]])
+    return True
 
 
-def search_wallets(name_filter: str, mk_name: str, provided_master_key: str):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT id, name, login, password, host FROM wallets WHERE mk_name=?",
-        (mk_name,)
-    )
-    rows = cursor.fetchall()
-    conn.close()
-
-    results = []
-    for r in rows:
-        wid, name_enc, login_enc, pass_enc, host_enc = r
-        entry = {"id": wid, "name": None, "login": None, "password": None, "host": None, "decrypted": False}
-        try:
-            name_dec = decrypt_data(name_enc, provided_master_key)
-            login_dec = decrypt_data(login_enc, provided_master_key)
-            pass_dec = decrypt_data(pass_enc, provided_master_key)
-            host_dec = decrypt_data(host_enc, provided_master_key)
-            entry.update({
-                "name": name_dec,
-                "login": login_dec,
-                "password": pass_dec,
-                "host": host_dec,
-                "decrypted": True
-            })
-        except (InvalidToken, Exception):
-            entry.update({
-                "name": None,
-                "login": None,
-                "password": None,
-                "host": None,
-                "decrypted": False
-            })
-        results.append(entry)
+# Сколько строк читается из БД за один короткий запрос при обходе хранилища
+SCAN_BATCH = 256
+
+# Параллельная расшифровка больших хранилищ. Пачка из PARALLEL_DECRYPT_MIN
+# строк и больше делится между DECRYPT_WORKERS потоками; меньшие пачки
+# расшифровываются в текущем потоке, где нет накладных расходов пула.
+# При обходе без limit пачки растут вдвое до MAX_SCAN_BATCH, так что
+# маленькие хранилища остаются на последовательном пути.
+DECRYPT_WORKERS = int(os.environ.get("KS_DECRYPT_WORKERS", str(min(4, os.cpu_count() or 1))))
+PARALLEL_DECRYPT_MIN = int(os.environ.get("KS_PARALLEL_DECRYPT_MIN", "512"))
+MAX_SCAN_BATCH = max(SCAN_BATCH, PARALLEL_DECRYPT_MIN * DECRYPT_WORKERS)
+
+_decrypt_executor = None
+_decrypt_executor_lock = threading.Lock()
+
 
+def _decrypt_chunk(rows, master_key: str, with_secrets: bool = False) -> list:
+    return [_decrypt_entry(r, master_key, with_secrets) for r in rows]
+
+
+def decrypt_rows(rows, master_key: str, with_secrets: bool = False) -> list:
+    """Расшифровывает строки кошельков, при большом числе строк — в пуле потоков."""
+    if DECRYPT_WORKERS <= 1 or len(rows) < PARALLEL_DECRYPT_MIN:
+        return _decrypt_chunk(rows, master_key, with_secrets)
+
+    global _decrypt_executor
+    if _decrypt_executor is None:
+        with _decrypt_executor_lock:
+            if _decrypt_executor is None:
+                _decrypt_executor = ThreadPoolExecutor(max_workers=DECRYPT_WORKERS, thread_name_prefix="ks-decrypt")
+    size = -(-len(rows) // DECRYPT_WORKERS)
+    chunks = [rows[i:i + size] for i in range(0, len(rows), size)]
+    entries = []
+    for part in _decrypt_executor.map(_decrypt_chunk, chunks, [master_key] * len(chunks), [with_secrets] * len(chunks)):
+        entries.extend(part)
+    return entries
+
+
+def iter_wallets(name_filter: str, mk_name: str, provided_master_key: str, after_id: int = 0, limit: int = None,
+                 with_secrets: bool = False, version: int = None):
+    """Выдает кошельки владельца provided_master_key в порядке id.
+
+    Записи содержат id, decrypted и DISPLAY_FIELDS; логин и пароль
+    расшифровываются только с with_secrets (или по одному через
+    get_wallet_secret). Кэшируются только записи без секретов.
+
+    Если хранилище есть в кэше и его номер изменения совпадает с текущим
+    номером владельца в БД, записи берутся из памяти. Запрос без limit
+    (полный список или поиск) при промахе читает и кэширует все хранилище,
+    запрос страницы при промахе читает БД напрямую (см. _scan_wallets).
+    Выдаются копии записей, поэтому кэш нельзя изменить через результат.
+    version — номер изменения владельца, уже прочитанный вызывающим (например,
+    для ETag): тогда кэш сверяется с ним, а не с повторно прочитанным.
+    """
+    vault = None
+    if provided_master_key and mk_name == provided_master_key[:4] and not with_secrets:
+        owner_id = wallet_owner_id(provided_master_key)
+        # Номер читается до хранилища: запись, попавшая между ними, даст
+        # несовпадение при следующем get, а не устаревший кэш
+        if version is None:
+            version = get_change_version(wallets_scope(owner_id))
+        vault = _vault_cache.get(owner_id, version)
+        if vault is None and limit is None:
+            claim_legacy_wallets(provided_master_key)
+        if vault is None and limit is None and _count_wallets(owner_id) <= _vault_cache.max_rows:
+            started = _vault_cache.begin()
+            vault = tuple(_scan_wallets("", mk_name, provided_master_key))
+            _vault_cache.put(owner_id, vault, started, version)
+    if vault is None:
+        yield from _scan_wallets(name_filter, mk_name, provided_master_key, after_id, limit, with_secrets)
+        return
+
+    nf_lower = name_filter.lower() if name_filter else None
+    remaining = limit
+    for entry in vault:
+        if entry["id"] <= (after_id or 0):
+            continue
+        if nf_lower is not None and not (entry["decrypted"] and nf_lower in entry["name"].lower()):
+            continue
+        yield dict(entry)
+        if remaining is not None:
+            remaining -= 1
+            if remaining == 0:
+                return
+
+
+def _count_wallets(owner_id: str) -> int:
+    with db_connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM wallets WHERE owner_id=?", (owner_id,)).fetchone()[0]
+
+
+def _scan_wallets(name_filter: str, mk_name: str, provided_master_key: str, after_id: int = 0, limit: int = None,
+                  with_secrets: bool = False, since: int = 0):
+    """Лениво выдает кошельки владельца provided_master_key из БД в порядке id.
+
+    Строки выбираются по owner_id (индекс (owner_id, id) — страница after_id
+    читает только свои строки, без сортировки); старым записям owner_id
+    сначала назначает claim_legacy_wallets. Строки читаются пачками, начиная с
+    SCAN_BATCH (соединение не удерживается между пачками), и расшифровываются
+    пачкой по мере потребления генератора; большие пачки — параллельно. after_id и limit задают страницу: выдаются
+    записи с id > after_id, не больше limit штук. С since выдаются только
+    записи, измененные после этого номера изменения (см. wallet_changes).
+    """
+    if not provided_master_key:
+        return
+    claim_legacy_wallets(provided_master_key)
+    query = (
+        "SELECT id, version, name, login, password, host, data, secret, name_indexed FROM wallets "
+        "WHERE owner_id=?"
+    )
+    params = [wallet_owner_id(provided_master_key)]
     if name_filter:
-        nf_lower = name_filter.lower()
-        filtered = []
-        for e in results:
-            if e["decrypted"] and nf_lower in e["name"].lower():
-                filtered.append(e)
-        return filtered
+        # Кандидаты выбираются по слепому индексу; еще не проиндексированные
+        # строки проверяются расшифровкой, как раньше
+        tokens = sorted(name_query_tokens(name_filter, provided_master_key))
+        placeholders = ",".join("?" * len(tokens))
+        query += (
+            " AND (name_indexed=0 OR id IN ("
+            f"SELECT wallet_id FROM wallet_name_tokens WHERE token IN ({placeholders}) "
+            "GROUP BY wallet_id HAVING COUNT(*)=?))"
+        )
+        params += tokens + [len(tokens)]
+    if since:
+        query += " AND changed>?"
+        params.append(since)
+    query += " AND id>? ORDER BY id LIMIT ?"
+    nf_lower = name_filter.lower() if name_filter else None
+
+    last_id = after_id or 0
+    remaining = limit
+    scan = SCAN_BATCH
+    while remaining is None or remaining > 0:
+        batch = scan if remaining is None or name_filter else min(scan, remaining)
+        with db_connection() as conn:
+            rows = conn.execute(query, params + [last_id, batch]).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        scan = min(scan * 2, MAX_SCAN_BATCH)
+
+        backfill = []
+        for r, entry in zip(rows, decrypt_rows(rows, provided_master_key, with_secrets)):
+            if entry["decrypted"] and not r[8]:
+                backfill.append((r[0], entry["name"]))
+            if nf_lower is not None and not (entry["decrypted"] and nf_lower in entry["name"].lower()):
+                continue
+            yield entry
+            if remaining is not None:
+                remaining -= 1
+                if remaining == 0:
+                    break
+
+        if backfill:
+            # Достраиваем индекс имен для старых записей при первом успешном чтении
+            with db_connection() as conn:
+                for wid, name in backfill:
+                    _write_name_index(conn, wid, name, provided_master_key)
+
+        if len(rows) < batch:
+            return
+
+
+def _decrypt_entry(row, master_key: str, with_secrets: bool = False) -> dict:
+    fields = WALLET_FIELDS if with_secrets else DISPLAY_FIELDS
+    entry = {"id": row[0], **dict.fromkeys(fields), "decrypted": False}
+    try:
+        entry.update(decrypt_record(row[1:8], master_key, with_secrets))
+        entry["decrypted"] = True
+    except (InvalidToken, Exception):
+        entry.update(dict.fromkeys(fields))
+        entry["decrypted"] = False
+    return entry
+
+
+def get_wallet_secret(wallet_id: int, master_key: str):
+    """Расшифровывает логин и пароль одного кошелька владельца master_key.
+
+    Возвращает {"login": ..., "password": ...} или None, если кошелька нет
+    или ключ к нему не подходит.
+    """
+    if not master_key:
+        return None
+    claim_legacy_wallets(master_key)
+    with db_connection() as conn:
+        row = conn.execute(
+            "SELECT version, name, login, password, host, data, secret FROM wallets WHERE id=? AND owner_id=?",
+            (wallet_id, wallet_owner_id(master_key))
+        ).fetchone()
+    if row is None:
+        return None
+    try:
+        if row[0] >= 3:
+            fields = json.loads(decrypt_data(row[6], master_key))
+        else:
+            fields = decrypt_record(row, master_key)
+    except InvalidToken:
+        return None
+    return {k: fields[k] for k in SECRET_FIELDS}
+
+
+def search_wallets(name_filter: str, mk_name: str, provided_master_key: str, with_secrets: bool = False):
+    """Все кошельки владельца списком (см. iter_wallets)."""
+    return list(iter_wallets(name_filter, mk_name, provided_master_key, with_secrets=with_secrets))
+
+
+def wallet_changes(provided_master_key: str, since: int = 0, version: int = None) -> dict:
+    """Изменения хранилища владельца после номера since.
+
+    Возвращает {"version": N, "full": bool, "items": [...]}: клиент хранит N
+    и в следующий раз передает его как since. При since=0 (или неизвестном
+    клиенту номере больше текущего) items — все хранилище (через кэш
+    iter_wallets, сверенный с тем же номером) и full=True, иначе — только
+    записи с changed > since. Номер читается до записей, поэтому снимок не
+    бывает старше номера, а запись, зафиксированная между двумя чтениями,
+    в худшем случае придет повторно — клиент объединяет по id.
+    version — номер, уже прочитанный вызывающим (например, для ETag).
+    """
+    if not provided_master_key:
+        return {"version": 0, "full": True, "items": []}
+    mk_name = provided_master_key[:4]
+    if version is None:
+        version = get_change_version(wallets_scope(wallet_owner_id(provided_master_key)))
+    if since <= 0 or since > version:
+        items = list(iter_wallets("", mk_name, provided_master_key, version=version))
+        return {"version": version, "full": True, "items": items}
+    items = list(_scan_wallets("", mk_name, provided_master_key, since=since)) if since < version else []
+    return {"version": version, "full": False, "items": items}
+
+
+def _backfill_wallets(condition: str, handler, batch_size: int, progress=None) -> int:
+    """Обходит строки кошельков всех пользователей, подходящие под condition.
+
+    Старым строкам пользователя сначала назначается owner_id (см.
+    claim_legacy_wallets), затем его строки выбираются по owner_id и
+    расшифровываются его мастер-ключом. handler(conn, row, fields, master_key) вызывается для каждой
+    расшифрованной строки. Каждая пачка фиксируется отдельной транзакцией,
+    поэтому обход можно прервать и запустить повторно.
+    progress(total) вызывается после каждой пачки.
+    """
+    with db_connection() as conn:
+        owners = conn.execute("SELECT master_key FROM users").fetchall()
+
+    total = 0
+    for (master_key,) in owners:
+        claim_legacy_wallets(master_key, batch_size)
+        last_id = 0
+        while True:
+            with db_connection() as conn:
+                rows = conn.execute(
+                    "SELECT id, version, name, login, password, host, data, secret FROM wallets "
+                    f"WHERE owner_id=? AND {condition} AND id>? ORDER BY id LIMIT ?",
+                    (wallet_owner_id(master_key), last_id, batch_size)
+                ).fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                for r in rows:
+                    try:
+                        fields = decrypt_record(r[1:], master_key)
+                    except InvalidToken:
+                        continue
+                    handler(conn, r, fields, master_key)
+                    total += 1
+            if progress:
+                progress(total)
+    return total
+
+
+def migrate_wallet_records(batch_size: int = 500, progress=None) -> int:
+    """Переписывает записи старых форматов (1 и 2) в текущий пачками по batch_size строк."""
+    def rewrite(conn, row, fields, master_key):
+        data, secret = encrypt_record(fields, master_key)
+        conn.execute(
+            "UPDATE wallets SET version=?, data=?, secret=?, name='', login='', password='', host='' WHERE id=?",
+            (RECORD_VERSION, data, secret, row[0])
+        )
+
+    return _backfill_wallets(f"version<{RECORD_VERSION}", rewrite, batch_size, progress)
+
+
+def reindex_wallet_names(batch_size: int = 500, progress=None) -> int:
+    """Строит слепой индекс имен для еще не проиндексированных кошельков всех пользователей."""
+    def index(conn, row, fields, master_key):
+        _write_name_index(conn, row[0], fields["name"], master_key)
 
-    return results
+    return _backfill_wallets("name_indexed=0", index, batch_size, progress)
 
 
+def migrate_wallet_owners(batch_size: int = 500, progress=None) -> int:
+    """Назначает owner_id кошелькам, которые пока различаются только по mk_name."""
+    with db_connection() as conn:
+        owners = conn.execute("SELECT master_key FROM users").fetchall()
+    total = 0
+    for (master_key,) in owners:
+        # Повторный запуск команды снова проверяет всех владельцев
+        with _claimed_owners_lock:
+            _claimed_owners.discard(wallet_owner_id(master_key))
+        total += claim_legacy_wallets(master_key, batch_size)
+        if progress:
+            progress(total)
+    return total
 
-create_db()
-create_wallets_table()
-create_requests_table()
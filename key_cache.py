@@ -0,0 +1,56 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class KeyCache:
+    """Ограниченный LRU-кэш производных ключей с истечением по TTL.
+
+    Ключом служит мастер-ключ, значения живут только в памяти процесса и
+    удаляются по истечении ``ttl`` секунд, при вытеснении или явно через
+    ``forget()``/``clear()`` (например, при выходе пользователя).
+    """
+
+    def __init__(self, max_size: int = 128, ttl: float = 900.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_create(self, key, factory):
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and item[1] > now:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            self.misses += 1
+
+        value = factory()
+        with self._lock:
+            self._items[key] = (value, now + self.ttl)
+            self._items.move_to_end(key)
+            self._evict(now)
+        return value
+
+    def _evict(self, now):
+        expired = [k for k, (_, expires) in self._items.items() if expires <= now]
+        for k in expired:
+            del self._items[k]
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def forget(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._items)}
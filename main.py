@@ -15,7 +15,9 @@ import logging
 from logging.handlers import RotatingFileHandler
 
 # Предполагается, что эти функции находятся в файле init_db.py
-from init_db import add_user, check_user, add_wallet, search_wallets, send_master_key_request, get_received_requests, respond_to_request, get_shared_master_keys
+from init_db import add_user, check_user, add_wallet, search_wallets, get_wallet_secret, send_master_key_request, REQUEST_ALREADY_PENDING, get_received_requests, respond_to_request, get_shared_master_keys, forget_master_key, requests_scope
+from gui_tasks import TaskRunner
+import events
 
 # --- СТИЛИЗАЦИЯ И ТЕМА ---
 STYLE = {
@@ -205,6 +207,119 @@ def create_modern_label(parent, text, **kwargs):
     
     return tk.Label(parent, text=text, **default_kwargs)
 
+def task_runner(widget) -> TaskRunner:
+    """Общий пул фоновых задач приложения (создается в App)."""
+    return widget.nametowidget(".").tasks
+
+def busy_cursor(widget, *buttons):
+    """Индикатор занятости для TaskRunner: курсор ожидания и выключенные кнопки."""
+    def set_busy(on):
+        widget.config(cursor="watch" if on else "")
+        for button in buttons:
+            button.config(state="disabled" if on else "normal")
+    return set_busy
+
+def show_task_error(parent):
+    """Обработчик ошибок фоновой задачи: пишет в лог и показывает сообщение."""
+    def on_error(error):
+        logging.error("Ошибка фоновой операции", exc_info=error)
+        messagebox.showerror("Ошибка", f"❌ Операция не выполнена: {error}", parent=parent)
+    return on_error
+
+class VirtualCardList(tk.Frame):
+    """Прокручиваемый список карточек одинаковой высоты с переиспользованием виджетов.
+
+    Карточки создаются только для видимых строк (плюс запас в одну строку) и
+    при прокрутке перепривязываются к другим записям, поэтому число
+    виджетов и стоимость отрисовки не зависят от длины списка.
+    make_card(parent) создает пустую карточку, bind_card(card, item)
+    заполняет ее данными записи.
+    """
+
+    def __init__(self, parent, row_height, make_card, bind_card, **kwargs):
+        super().__init__(parent, **kwargs)
+        self.row_height = row_height
+        self.make_card = make_card
+        self.bind_card = bind_card
+        self.items = []
+        self._slots = []  # [(карточка, id окна на canvas)]
+        self._bound = {}  # номер слота -> индекс привязанной записи
+
+        self.canvas = tk.Canvas(self, bg=self.cget("bg"), highlightthickness=0,
+                                yscrollincrement=max(1, row_height // 4))
+        self.scrollbar = tk.Scrollbar(self, orient="vertical", command=self.canvas.yview, bg=STYLE["entry_bg_color"])
+        self.canvas.configure(yscrollcommand=self._on_view_changed)
+        self.canvas.pack(side="left", fill="both", expand=True)
+        self.scrollbar.pack(side="right", fill="y")
+
+        self.message = create_modern_label(self.canvas, "", font=STYLE["font_medium"])
+
+        self.canvas.bind("<Configure>", self._on_resize)
+        # Колесо мыши прокручивает список, пока курсор над ним
+        self.canvas.bind("<Enter>", lambda e: self.canvas.bind_all("<MouseWheel>", self._on_mousewheel))
+        self.canvas.bind("<Leave>", lambda e: self.canvas.unbind_all("<MouseWheel>"))
+
+    def set_items(self, items):
+        self.items = list(items)
+        self.message.place_forget()
+        self._bound.clear()
+        self._update_scrollregion()
+        self.canvas.yview_moveto(0)
+        self._refresh()
+
+    def show_message(self, text, color):
+        self.set_items([])
+        self.message.config(text=text, fg=color)
+        self.message.place(relx=0.5, y=STYLE["padding_large"], anchor="n")
+
+    def _update_scrollregion(self):
+        height = max(len(self.items) * self.row_height, self.canvas.winfo_height())
+        self.canvas.configure(scrollregion=(0, 0, self.canvas.winfo_width(), height))
+
+    def _ensure_slots(self):
+        needed = self.canvas.winfo_height() // self.row_height + 2
+        while len(self._slots) < needed:
+            card = self.make_card(self.canvas)
+            window = self.canvas.create_window(
+                0, 0, window=card, anchor="nw",
+                width=self.canvas.winfo_width(), height=self.row_height - STYLE["padding_small"],
+                state="hidden",
+            )
+            self._slots.append((card, window))
+        return len(self._slots)
+
+    def _refresh(self):
+        count = self._ensure_slots()
+        first = int(self.canvas.canvasy(0)) // self.row_height
+        visible = set()
+        for index in range(first, min(first + count, len(self.items))):
+            slot = index % count
+            visible.add(slot)
+            card, window = self._slots[slot]
+            self.canvas.coords(window, 0, index * self.row_height)
+            if self._bound.get(slot) != index:
+                self.bind_card(card, self.items[index])
+                self._bound[slot] = index
+            self.canvas.itemconfigure(window, state="normal")
+        for slot, (card, window) in enumerate(self._slots):
+            if slot not in visible:
+                self.canvas.itemconfigure(window, state="hidden")
+                self._bound.pop(slot, None)
+
+    def _on_view_changed(self, first, last):
+        self.scrollbar.set(first, last)
+        self._refresh()
+
+    def _on_resize(self, event):
+        for _, window in self._slots:
+            self.canvas.itemconfigure(window, width=event.width)
+        self._update_scrollregion()
+        self._refresh()
+
+    def _on_mousewheel(self, event):
+        self.canvas.yview_scroll(int(-event.delta / 120) * 4, "units")
+
+
 # --- КЛАССЫ ОКОН ПРИЛОЖЕНИЯ ---
 
 class BaseWindow(tk.Toplevel):
@@ -304,6 +419,9 @@ class CreateWalletWindow(BaseWindow):
 
 class SearchWalletWindow(BaseWindow):
     """Окно для поиска кошельков."""
+    # Высота строки виртуального списка (карточка и отступ под ней)
+    CARD_HEIGHT = 175
+
     def __init__(self, master_key):
         super().__init__("Поиск кошельков", 800, 700)
         self.master_key = master_key
@@ -346,7 +464,8 @@ class SearchWalletWindow(BaseWindow):
         button_frame = tk.Frame(search_card, bg=STYLE["card_bg_color"])
         button_frame.pack(fill="x", padx=STYLE["padding"], pady=(0, STYLE["padding"]))
         
-        create_modern_button(button_frame, "🔄 Обновить / Фильтровать", self.show_wallets, width=30).pack(side="left")
+        self.search_button = create_modern_button(button_frame, "🔄 Обновить / Фильтровать", self.show_wallets, width=30)
+        self.search_button.pack(side="left")
         create_modern_button(button_frame, "➕ Создать новый", lambda: CreateWalletWindow(self.master_key), width=20).pack(side="right")
         
         # Результаты в отдельной карточке
@@ -358,21 +477,16 @@ class SearchWalletWindow(BaseWindow):
         results_header.pack(fill="x", padx=STYLE["padding"], pady=STYLE["padding"])
         
         create_modern_label(results_header, "📋 Результаты поиска", font=STYLE["font_medium"], fg=STYLE["accent_color"]).pack(side="left")
-        
-        # Область прокрутки для результатов
-        canvas_frame = tk.Frame(results_card, bg=STYLE["card_bg_color"])
-        canvas_frame.pack(fill="both", expand=True, padx=STYLE["padding"], pady=(0, STYLE["padding"]))
-        
-        canvas = tk.Canvas(canvas_frame, bg=STYLE["secondary_bg_color"], highlightthickness=0)
-        scrollbar = tk.Scrollbar(canvas_frame, orient="vertical", command=canvas.yview, bg=STYLE["entry_bg_color"])
-        self.inner_frame = tk.Frame(canvas, bg=STYLE["secondary_bg_color"])
-
-        self.inner_frame.bind("<Configure>", lambda e: canvas.configure(scrollregion=canvas.bbox("all")))
-        canvas.create_window((0, 0), window=self.inner_frame, anchor="nw")
-        canvas.configure(yscrollcommand=scrollbar.set)
-        
-        canvas.pack(side="left", fill="both", expand=True)
-        scrollbar.pack(side="right", fill="y")
+        self.status_label = create_modern_label(results_header, "", font=STYLE["font_small"], fg=STYLE["warning_color"])
+        self.status_label.pack(side="right")
+        
+        # Список результатов: карточки создаются только для видимых строк
+        self.wallet_list = VirtualCardList(
+            results_card, self.CARD_HEIGHT, self.make_wallet_card, self.bind_wallet_card,
+            bg=STYLE["secondary_bg_color"],
+        )
+        self.wallet_list.pack(fill="both", expand=True, padx=STYLE["padding"], pady=(0, STYLE["padding"]))
+        self.list_master_key = ""
     
     def clear_search_placeholder(self):
         if self.entry_name.get() == "Введите название для поиска...":
@@ -385,9 +499,6 @@ class SearchWalletWindow(BaseWindow):
             self.entry_name.config(fg=STYLE["accent_color"])
 
     def show_wallets(self):
-        for widget in self.inner_frame.winfo_children():
-            widget.destroy()
-
         name_filter = self.entry_name.get().strip()
         if name_filter == "Введите название для поиска...":
             name_filter = ""
@@ -395,73 +506,117 @@ class SearchWalletWindow(BaseWindow):
         mk4 = provided_mk[:4] if provided_mk else ""
 
         if not mk4:
-            error_frame = tk.Frame(self.inner_frame, bg=STYLE["secondary_bg_color"])
-            error_frame.pack(fill="x", padx=STYLE["padding"], pady=STYLE["padding"])
-            create_modern_label(error_frame, "⚠️ Введите полный мастер-ключ для поиска.", fg=STYLE["error_color"], font=STYLE["font_medium"]).pack(pady=STYLE["padding"])
+            self.wallet_list.show_message("⚠️ Введите полный мастер-ключ для поиска.", STYLE["error_color"])
             return
 
-        wallets = search_wallets(name_filter, mk4, provided_mk)
-
+        # Поиск и расшифровка идут в фоне; повторный поиск вытесняет предыдущий
+        task_runner(self).submit(
+            search_wallets, name_filter, mk4, provided_mk,
+            on_done=lambda wallets: self.display_wallets(wallets, provided_mk),
+            on_error=show_task_error(self),
+            channel=f"{self}:search",
+            busy=self.set_searching,
+            owner=self,
+        )
+
+    def set_searching(self, on):
+        self.status_label.config(text="⏳ Поиск..." if on else "")
+        self.config(cursor="watch" if on else "")
+
+    def display_wallets(self, wallets, provided_mk):
         if not wallets:
-            no_results_frame = tk.Frame(self.inner_frame, bg=STYLE["secondary_bg_color"])
-            no_results_frame.pack(fill="x", padx=STYLE["padding"], pady=STYLE["padding"])
-            create_modern_label(no_results_frame, "🔍 Ничего не найдено", fg=STYLE["warning_color"], font=STYLE["font_medium"]).pack(pady=STYLE["padding"])
+            self.wallet_list.show_message("🔍 Ничего не найдено", STYLE["warning_color"])
             return
 
-        for i, e in enumerate(wallets):
-            # Создаем карточку кошелька
-            wallet_card = create_card_frame(self.inner_frame)
-            wallet_card.pack(fill="x", padx=STYLE["padding"], pady=STYLE["padding_small"])
-            
-            # Заголовок карточки
-            header_frame = tk.Frame(wallet_card, bg=STYLE["card_bg_color"])
-            header_frame.pack(fill="x", padx=STYLE["padding"], pady=(STYLE["padding"], 0))
-            
-            if e["decrypted"]:
-                name, login, pwd, host = e["name"], e["login"], e["password"], e["host"]
-                status = "✅ Дешифровано"
-                status_color = STYLE["success_color"]
-                status_icon = "🔓"
+        self.list_master_key = provided_mk
+        self.wallet_list.set_items(wallets)
+
+    def make_wallet_card(self, parent):
+        """Создает пустую карточку кошелька для виртуального списка."""
+        card = create_card_frame(parent)
+
+        # Заголовок карточки: название и статус
+        header_frame = tk.Frame(card, bg=STYLE["card_bg_color"])
+        header_frame.pack(fill="x", padx=STYLE["padding"], pady=(STYLE["padding"], 0))
+        card.name_label = create_modern_label(header_frame, "", font=STYLE["font_semibold"], fg=STYLE["accent_color"])
+        card.name_label.pack(side="left")
+        card.status_label = create_modern_label(header_frame, "", font=STYLE["font_medium"])
+        card.status_label.pack(side="right")
+
+        # Детали кошелька
+        details_frame = tk.Frame(card, bg=STYLE["card_bg_color"])
+        details_frame.pack(fill="x", padx=STYLE["padding"], pady=(STYLE["padding_small"], STYLE["padding"]))
+        details_frame.grid_columnconfigure(1, weight=1)
+        values = []
+        for row, caption in enumerate(("👤 Логин:", "🔑 Пароль:", "🌐 Хост:")):
+            create_modern_label(details_frame, caption, font=STYLE["font_medium"], fg=STYLE["accent_color"]).grid(row=row, column=0, sticky="w", padx=(0, STYLE["padding_small"]))
+            value = create_modern_label(details_frame, "", font=STYLE["font_medium"])
+            value.grid(row=row, column=1, sticky="w")
+            values.append(value)
+        card.login_label, card.password_label, card.host_label = values
+
+        # Кнопки действий (только для расшифрованных кошельков)
+        card.actions_frame = tk.Frame(card, bg=STYLE["card_bg_color"])
+        card.copy_button = create_modern_button(card.actions_frame, "📋 Копировать пароль", None, width=20)
+        card.copy_button.pack(side="left", padx=(0, STYLE["padding_small"]))
+        card.show_button = create_modern_button(card.actions_frame, "👁️ Показать/скрыть", None, width=20)
+        card.show_button.pack(side="left")
+        return card
+
+    def bind_wallet_card(self, card, e):
+        """Заполняет карточку данными кошелька e."""
+        # Логин и пароль не входят в список и расшифровываются по кнопке
+        if e["decrypted"]:
+            name, login, pwd, host = e["name"], "••••••••", "••••••••", e["host"]
+            status = "🔓 ✅ Дешифровано"
+            status_color = STYLE["success_color"]
+        else:
+            name, login, pwd, host = "*** (зашифровано)", "***", "***", "***"
+            status = "🔒 ❌ Не расшифровано (неверный мастер-ключ)"
+            status_color = STYLE["error_color"]
+
+        card.name_label.config(text=f"💼 {name}")
+        card.status_label.config(text=status, fg=status_color)
+        card.login_label.config(text=login)
+        card.password_label.config(text=pwd)
+        card.host_label.config(text=host)
+
+        if not e["decrypted"]:
+            card.actions_frame.pack_forget()
+            return
+
+        def copy_secret(secret):
+            copy_to_clipboard(self, secret["password"], timeout=20)
+            messagebox.showinfo("Скопировано", "📋 Пароль скопирован в буфер обмена! (будет очищен)", parent=self)
+
+        def make_copy(wallet_id=e["id"], mk=self.list_master_key):
+            self.load_secret(wallet_id, mk, copy_secret)
+
+        def make_show(wallet_id=e["id"], mk=self.list_master_key, h=host):
+            self.load_secret(
+                wallet_id, mk,
+                lambda secret: self.toggle_password_visibility(secret["password"], secret["login"], h)
+            )
+
+        card.copy_button.config(command=make_copy)
+        card.show_button.config(command=make_show)
+        card.actions_frame.pack(fill="x", padx=STYLE["padding"], pady=(0, STYLE["padding"]))
+
+    def load_secret(self, wallet_id, master_key, on_secret):
+        """Расшифровывает логин и пароль кошелька в фоне и передает их в on_secret."""
+        def done(secret):
+            if secret is None:
+                messagebox.showerror("Ошибка", "❌ Не удалось расшифровать кошелек", parent=self)
             else:
-                name, login, pwd, host = "*** (зашифровано)", "***", "***", "***"
-                status = "❌ Не расшифровано (неверный мастер-ключ)"
-                status_color = STYLE["error_color"]
-                status_icon = "🔒"
-            
-            # Название и статус
-            create_modern_label(header_frame, f"💼 {name}", font=STYLE["font_semibold"], fg=STYLE["accent_color"]).pack(side="left")
-            create_modern_label(header_frame, f"{status_icon} {status}", font=STYLE["font_medium"], fg=status_color).pack(side="right")
-            
-            # Детали кошелька
-            details_frame = tk.Frame(wallet_card, bg=STYLE["card_bg_color"])
-            details_frame.pack(fill="x", padx=STYLE["padding"], pady=(STYLE["padding_small"], STYLE["padding"]))
-            
-            # Создаем сетку для деталей
-            details_frame.grid_columnconfigure(1, weight=1)
-            
-            # Логин
-            create_modern_label(details_frame, "👤 Логин:", font=STYLE["font_medium"], fg=STYLE["accent_color"]).grid(row=0, column=0, sticky="w", padx=(0, STYLE["padding_small"]))
-            create_modern_label(details_frame, login, font=STYLE["font_medium"]).grid(row=0, column=1, sticky="w")
-            
-            # Пароль
-            create_modern_label(details_frame, "🔑 Пароль:", font=STYLE["font_medium"], fg=STYLE["accent_color"]).grid(row=1, column=0, sticky="w", padx=(0, STYLE["padding_small"]))
-            create_modern_label(details_frame, pwd, font=STYLE["font_medium"]).grid(row=1, column=1, sticky="w")
-            
-            # Хост
-            create_modern_label(details_frame, "🌐 Хост:", font=STYLE["font_medium"], fg=STYLE["accent_color"]).grid(row=2, column=0, sticky="w", padx=(0, STYLE["padding_small"]))
-            create_modern_label(details_frame, host, font=STYLE["font_medium"]).grid(row=2, column=1, sticky="w")
-            
-            # Кнопки действий
-            if e["decrypted"]:
-                actions_frame = tk.Frame(wallet_card, bg=STYLE["card_bg_color"])
-                actions_frame.pack(fill="x", padx=STYLE["padding"], pady=(0, STYLE["padding"]))
-                
-                def make_copy(password=pwd):
-                    copy_to_clipboard(self, password, timeout=20)
-                    messagebox.showinfo("Скопировано", "📋 Пароль скопирован в буфер обмена! (будет очищен)", parent=self)
-                
-                create_modern_button(actions_frame, "📋 Копировать пароль", make_copy, width=20).pack(side="left", padx=(0, STYLE["padding_small"]))
-                create_modern_button(actions_frame, "👁️ Показать/скрыть", lambda p=pwd, l=login, h=host: self.toggle_password_visibility(p, l, h), width=20).pack(side="left")
+                on_secret(secret)
+
+        task_runner(self).submit(
+            get_wallet_secret, wallet_id, master_key,
+            on_done=done,
+            on_error=show_task_error(self),
+            busy=busy_cursor(self),
+            owner=self,
+        )
     
     def toggle_password_visibility(self, password, login, host):
         """Переключает видимость пароля в отдельном окне."""
@@ -502,10 +657,14 @@ class SearchWalletWindow(BaseWindow):
 
 class MasterKeysWindow(BaseWindow):
     """Окно для управления мастер-ключами."""
+    # Общих ключей на одной странице; следующие загружаются кнопкой «Показать еще»
+    PAGE_SIZE = 50
+
     def __init__(self, username, master_key):
         super().__init__("Управление мастер-ключами", 800, 600)
         self.username = username
         self.master_key = master_key
+        self.next_after = None
         self.create_widgets()
         self.load_shared_keys()
 
@@ -546,10 +705,14 @@ class MasterKeysWindow(BaseWindow):
         
         create_modern_label(shared_header, "🤝 Общие мастер-ключи", font=STYLE["font_medium"], fg=STYLE["accent_color"]).pack(side="left")
         create_modern_button(shared_header, "🔄 Обновить", self.load_shared_keys, width=15).pack(side="right")
+
+        # Кнопка следующей страницы (показывается, когда ключей больше PAGE_SIZE)
+        self.more_button = create_modern_button(shared_keys_card, "⬇️ Показать еще", lambda: self.load_shared_keys(self.next_after), width=20)
         
         # Область прокрутки для общих ключей
         canvas_frame = tk.Frame(shared_keys_card, bg=STYLE["card_bg_color"])
         canvas_frame.pack(fill="both", expand=True, padx=STYLE["padding"], pady=(0, STYLE["padding"]))
+        self.canvas_frame = canvas_frame
         
         canvas = tk.Canvas(canvas_frame, bg=STYLE["secondary_bg_color"], highlightthickness=0)
         scrollbar = tk.Scrollbar(canvas_frame, orient="vertical", command=canvas.yview, bg=STYLE["entry_bg_color"])
@@ -566,20 +729,36 @@ class MasterKeysWindow(BaseWindow):
         copy_to_clipboard(self, self.master_key, timeout=30)
         messagebox.showinfo("Скопировано", "📋 Мастер-ключ скопирован в буфер обмена! (будет очищен)", parent=self)
 
-    def load_shared_keys(self):
-        for widget in self.inner_frame.winfo_children():
-            widget.destroy()
-        
-        shared_keys = get_shared_master_keys(self.username)
+    def load_shared_keys(self, after_id=0):
+        """Загружает первую страницу общих ключей или, с after_id, следующую за ним."""
+        task_runner(self).submit(
+            get_shared_master_keys, self.username, after_id, self.PAGE_SIZE,
+            on_done=lambda shared_keys: self.display_shared_keys(shared_keys, append=bool(after_id)),
+            on_error=show_task_error(self),
+            channel=f"{self}:shared",
+            busy=busy_cursor(self),
+            owner=self,
+        )
+
+    def display_shared_keys(self, shared_keys, append=False):
+        if not append:
+            for widget in self.inner_frame.winfo_children():
+                widget.destroy()
+
+        self.next_after = shared_keys[-1][3] if len(shared_keys) == self.PAGE_SIZE else None
+        if self.next_after:
+            self.more_button.pack(side="bottom", pady=(0, STYLE["padding"]), before=self.canvas_frame)
+        else:
+            self.more_button.pack_forget()
         
-        if not shared_keys:
+        if not shared_keys and not append:
             no_keys_frame = tk.Frame(self.inner_frame, bg=STYLE["secondary_bg_color"])
             no_keys_frame.pack(fill="x", padx=STYLE["padding"], pady=STYLE["padding"])
             create_modern_label(no_keys_frame, "🔍 Нет общих мастер-ключей", fg=STYLE["warning_color"], font=STYLE["font_medium"]).pack(pady=STYLE["padding"])
             return
         
         for key_data in shared_keys:
-            username, master_key, status = key_data
+            username, master_key, status, _ = key_data
             
             key_card = create_card_frame(self.inner_frame)
             key_card.pack(fill="x", padx=STYLE["padding"], pady=STYLE["padding_small"])
@@ -682,7 +861,10 @@ class ShareKeyWindow(BaseWindow):
             return
         
         success = send_master_key_request(self.username, target_username)
-        if success:
+        if success == REQUEST_ALREADY_PENDING:
+            messagebox.showinfo("Запрос уже отправлен", f"⏳ Запрос пользователю {target_username} уже ожидает ответа.", parent=self)
+            self.destroy()
+        elif success:
             messagebox.showinfo("Успешно", f"✅ Запрос отправлен пользователю {target_username}!\nОжидайте одобрения.", parent=self)
             self.destroy()
         else:
@@ -691,11 +873,35 @@ class ShareKeyWindow(BaseWindow):
 
 class IncomingRequestsWindow(BaseWindow):
     """Окно для просмотра и обработки входящих запросов на мастер-ключ."""
+    # Как часто окно проверяет флаг новых событий (проверка в памяти, без БД)
+    EVENTS_CHECK_MS = 500
+    # Запросов на одной странице; следующие загружаются кнопкой «Показать еще»
+    PAGE_SIZE = 50
+    STATUS_FILTERS = (("Все", None), ("⏳ Ожидают", "pending"), ("✅ Приняты", "accepted"), ("❌ Отклонены", "rejected"))
+
     def __init__(self, username):
         super().__init__("Входящие запросы", 700, 500)
         self.username = username
+        self.status_filter = None
+        self.next_after = None
         self.create_widgets()
         self.load_requests()
+        # Слушатель шины вызывается в чужом потоке, поэтому только ставит флаг,
+        # а список перезагружается из главного цикла Tk
+        self._changed = threading.Event()
+        self._unsubscribe = events.subscribe(requests_scope(username), lambda event: self._changed.set())
+        self._events_job = self.after(self.EVENTS_CHECK_MS, self.check_events)
+
+    def check_events(self):
+        if self._changed.is_set():
+            self._changed.clear()
+            self.load_requests()
+        self._events_job = self.after(self.EVENTS_CHECK_MS, self.check_events)
+
+    def destroy(self):
+        self._unsubscribe()
+        self.after_cancel(self._events_job)
+        super().destroy()
 
     def create_widgets(self):
         # Заголовок
@@ -714,10 +920,25 @@ class IncomingRequestsWindow(BaseWindow):
         
         create_modern_label(requests_header, "📋 Список запросов", font=STYLE["font_medium"], fg=STYLE["accent_color"]).pack(side="left")
         create_modern_button(requests_header, "🔄 Обновить", self.load_requests, width=15).pack(side="right")
-        
+
+        # Фильтр по статусу
+        filters_frame = tk.Frame(requests_card, bg=STYLE["card_bg_color"])
+        filters_frame.pack(fill="x", padx=STYLE["padding"], pady=STYLE["padding_small"])
+        self.filter_buttons = {}
+        for label, status in self.STATUS_FILTERS:
+            button = create_modern_button(filters_frame, label, lambda s=status: self.set_status_filter(s),
+                                          font=STYLE["font_small"], height=1)
+            button.pack(side="left", padx=(0, STYLE["padding_small"]))
+            self.filter_buttons[status] = (button, label)
+        self.update_filter_buttons()
+
+        # Кнопка следующей страницы (показывается, когда запросов больше PAGE_SIZE)
+        self.more_button = create_modern_button(requests_card, "⬇️ Показать еще", lambda: self.load_requests(self.next_after), width=20)
+
         # Область прокрутки для запросов
         canvas_frame = tk.Frame(requests_card, bg=STYLE["card_bg_color"])
         canvas_frame.pack(fill="both", expand=True, padx=STYLE["padding"], pady=(0, STYLE["padding"]))
+        self.canvas_frame = canvas_frame
         
         canvas = tk.Canvas(canvas_frame, bg=STYLE["secondary_bg_color"], highlightthickness=0)
         scrollbar = tk.Scrollbar(canvas_frame, orient="vertical", command=canvas.yview, bg=STYLE["entry_bg_color"])
@@ -730,13 +951,57 @@ class IncomingRequestsWindow(BaseWindow):
         canvas.pack(side="left", fill="both", expand=True)
         scrollbar.pack(side="right", fill="y")
 
-    def load_requests(self):
-        for widget in self.inner_frame.winfo_children():
-            widget.destroy()
-        
-        requests = get_received_requests(self.username)
-        
-        if not requests:
+    def set_status_filter(self, status):
+        self.status_filter = status
+        self.update_filter_buttons()
+        self.load_requests()
+
+    def update_filter_buttons(self):
+        for status, (button, label) in self.filter_buttons.items():
+            button.config(text=f"● {label}" if status == self.status_filter else label)
+
+    def load_requests(self, after_id=0):
+        """Загружает первую страницу запросов или, с after_id, следующую за ним."""
+        username, status, limit = self.username, self.status_filter, self.PAGE_SIZE
+        task_runner(self).submit(
+            lambda: get_received_requests(username, status=status, after_id=after_id, limit=limit),
+            on_done=lambda requests: self.display_requests(requests, append=bool(after_id)),
+            on_error=show_task_error(self),
+            channel=f"{self}:requests",
+            busy=busy_cursor(self),
+            owner=self,
+        )
+
+    def respond(self, request_id, accept):
+        def done(ok):
+            if not ok:
+                messagebox.showerror("Ошибка", "Запрос не найден", parent=self)
+            elif accept:
+                messagebox.showinfo("Успешно", "✅ Запрос принят! Пользователь получил доступ к вашему мастер-ключу.", parent=self)
+            else:
+                messagebox.showinfo("Успешно", "❌ Запрос отклонен.", parent=self)
+            self.load_requests()
+
+        task_runner(self).submit(
+            respond_to_request, request_id, accept, self.username,
+            on_done=done,
+            on_error=show_task_error(self),
+            busy=busy_cursor(self),
+            owner=self,
+        )
+
+    def display_requests(self, requests, append=False):
+        if not append:
+            for widget in self.inner_frame.winfo_children():
+                widget.destroy()
+
+        self.next_after = requests[-1][0] if len(requests) == self.PAGE_SIZE else None
+        if self.next_after:
+            self.more_button.pack(side="bottom", pady=(0, STYLE["padding"]), before=self.canvas_frame)
+        else:
+            self.more_button.pack_forget()
+
+        if not requests and not append:
             no_requests_frame = tk.Frame(self.inner_frame, bg=STYLE["secondary_bg_color"])
             no_requests_frame.pack(fill="x", padx=STYLE["padding"], pady=STYLE["padding"])
             create_modern_label(no_requests_frame, "🔍 Нет входящих запросов", fg=STYLE["warning_color"], font=STYLE["font_medium"]).pack(pady=STYLE["padding"])
@@ -771,14 +1036,10 @@ class IncomingRequestsWindow(BaseWindow):
                 actions_frame.pack(fill="x", padx=STYLE["padding"], pady=(0, STYLE["padding"]))
                 
                 def accept_request(req_id=request_id):
-                    respond_to_request(req_id, True)
-                    messagebox.showinfo("Успешно", "✅ Запрос принят! Пользователь получил доступ к вашему мастер-ключу.", parent=self)
-                    self.load_requests()
+                    self.respond(req_id, True)
                 
                 def reject_request(req_id=request_id):
-                    respond_to_request(req_id, False)
-                    messagebox.showinfo("Успешно", "❌ Запрос отклонен.", parent=self)
-                    self.load_requests()
+                    self.respond(req_id, False)
                 
                 create_modern_button(actions_frame, "✅ Принять", accept_request, width=15).pack(side="left", padx=(0, STYLE["padding_small"]))
                 create_modern_button(actions_frame, "❌ Отклонить", reject_request, bg=STYLE["error_color"], width=15).pack(side="left")
@@ -891,9 +1152,11 @@ class MainApplication(tk.Toplevel):
 
     def on_closing(self):
         if messagebox.askokcancel("Выход", "Вы уверены, что хотите выйти из приложения?"):
+            forget_master_key(self.master_key)
             self.login_window.destroy()
 
     def logout(self):
+        forget_master_key(self.master_key)
         self.destroy()
         self.login_window.deiconify() # Показываем окно входа снова
 
@@ -966,8 +1229,10 @@ class LoginFrame(tk.Frame):
         buttons_frame = tk.Frame(form_content, bg=STYLE["card_bg_color"])
         buttons_frame.pack(fill="x", pady=(STYLE["padding_large"], 0))
         
-        create_modern_button(buttons_frame, "🚀 Войти", self.login, width=25).pack(side="left", padx=(0, STYLE["padding_small"]))
-        create_modern_button(buttons_frame, "📝 Регистрация", self.register, bg=STYLE["info_color"], width=25).pack(side="right")
+        self.login_button = create_modern_button(buttons_frame, "🚀 Войти", self.login, width=25)
+        self.login_button.pack(side="left", padx=(0, STYLE["padding_small"]))
+        self.register_button = create_modern_button(buttons_frame, "📝 Регистрация", self.register, bg=STYLE["info_color"], width=25)
+        self.register_button.pack(side="right")
         
         # Подсказка
         hint_frame = tk.Frame(main_container, bg=STYLE["bg_color"])
@@ -1015,7 +1280,15 @@ class LoginFrame(tk.Frame):
             messagebox.showwarning("Ошибка", "⚠️ Пожалуйста, введите имя пользователя и пароль!")
             return
         
-        user = check_user(username, password)
+        # bcrypt выполняется в фоне, окно остается отзывчивым
+        task_runner(self).submit(
+            check_user, username, password,
+            on_done=self.on_login_checked,
+            on_error=show_task_error(self),
+            busy=busy_cursor(self, self.login_button, self.register_button),
+        )
+
+    def on_login_checked(self, user):
         if user:
             messagebox.showinfo("Успешно", "✅ Добро пожаловать! Вы успешно вошли в систему.")
             self.master.withdraw() # Скрываем окно входа
@@ -1040,7 +1313,15 @@ class LoginFrame(tk.Frame):
             messagebox.showwarning("Ошибка", "⚠️ Пароль должен содержать минимум 6 символов!")
             return
         
-        if add_user(username, password):
+        task_runner(self).submit(
+            add_user, username, password,
+            on_done=self.on_registered,
+            on_error=show_task_error(self),
+            busy=busy_cursor(self, self.login_button, self.register_button),
+        )
+
+    def on_registered(self, created):
+        if created:
             messagebox.showinfo("Успешно", "🎉 Пользователь успешно зарегистрирован!\nТеперь вы можете войти в систему.")
         else:
             messagebox.showerror("Ошибка", "❌ Пользователь с таким именем уже существует.\nПопробуйте другое имя пользователя.")
@@ -1061,12 +1342,19 @@ class App(tk.Tk):
         except:
             pass  # Иконка не найдена, продолжаем без неё
 
+        # Пул фоновых задач для БД и криптографии (см. task_runner)
+        self.tasks = TaskRunner(self)
+
         login_frame = LoginFrame(self)
         login_frame.pack(expand=True)
         # Настройка логирования перед запуском серверных/фоновых задач
         self.setup_logging()
         self.start_server()
 
+    def destroy(self):
+        self.tasks.shutdown()
+        super().destroy()
+
     def setup_logging(self):
         try:
             log_dir = os.path.join(os.path.dirname(__file__), "logs")
@@ -1099,8 +1387,14 @@ class App(tk.Tk):
             try:
                 # Импортируем здесь, чтобы избежать влияния на время старта GUI
                 from web_app import app as flask_app
-                # Запускаем без перезагрузчика, в одном процессе
-                flask_app.run(debug=False, host='127.0.0.1', port=5000, use_reloader=False, threaded=True)
+                try:
+                    # waitress — многопоточный сервер без отладочных ограничений Werkzeug
+                    from waitress import serve
+                except ImportError:
+                    # Запускаем без перезагрузчика, в одном процессе
+                    flask_app.run(debug=False, host='127.0.0.1', port=5000, use_reloader=False, threaded=True)
+                else:
+                    serve(flask_app, host='127.0.0.1', port=5000, threads=8)
             except Exception:
                 logging.exception("Не удалось запустить Flask-сервер")
 
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Служебные команды keySecret для обслуживания базы данных
+"""
+
+import argparse
+import getpass
+import sys
+
+
+def cmd_migrate_wallets(args):
+    """Переводит записи кошельков в текущий формат (отдельные блоки для списка и секретов)"""
+    from init_db import migrate_wallet_records
+
+    print(f"🔄 Миграция записей кошельков (пачками по {args.batch_size})...")
+    total = migrate_wallet_records(
+        batch_size=args.batch_size,
+        progress=lambda n: print(f"   обработано записей: {n}"),
+    )
+    print(f"✅ Готово, переписано записей: {total}")
+
+
+def cmd_index_wallets(args):
+    """Строит слепой индекс имен для старых кошельков"""
+    from init_db import reindex_wallet_names
+
+    print("🔎 Построение индекса имен кошельков...")
+    total = reindex_wallet_names(
+        batch_size=args.batch_size,
+        progress=lambda n: print(f"   проиндексировано записей: {n}"),
+    )
+    print(f"✅ Готово, проиндексировано записей: {total}")
+
+
+def cmd_migrate_owners(args):
+    """Назначает кошелькам полноразмерный идентификатор владельца"""
+    from init_db import migrate_wallet_owners
+
+    print("👤 Назначение владельцев кошелькам...")
+    total = migrate_wallet_owners(
+        batch_size=args.batch_size,
+        progress=lambda n: print(f"   обработано записей: {n}"),
+    )
+    print(f"✅ Готово, назначено владельцев: {total}")
+
+
+def cmd_archive_requests(args):
+    """Переносит старые обработанные запросы на мастер-ключ в архив"""
+    from init_db import archive_requests, REQUEST_ARCHIVE_DAYS
+
+    days = REQUEST_ARCHIVE_DAYS if args.days is None else args.days
+    print(f"🗄️  Архивация запросов, обработанных более {days} дн. назад...")
+    total = archive_requests(
+        older_than_days=days,
+        batch_size=args.batch_size,
+        progress=lambda n: print(f"   перенесено запросов: {n}"),
+    )
+    print(f"✅ Готово, перенесено в архив: {total}")
+
+
+def cmd_import_wallets(args):
+    """Массово импортирует кошельки из CSV / JSON файла"""
+    from wallet_import import import_wallets, read_records, detect_format
+
+    master_key = args.master_key or getpass.getpass("Мастер-ключ: ")
+    fmt = args.format or detect_format(filename=args.file)
+    print(f"📥 Импорт кошельков из {args.file} (формат {fmt})...")
+    with open(args.file, encoding="utf-8", newline="") as f:
+        report = import_wallets(
+            read_records(f, fmt, master_key),
+            master_key,
+            chunk_size=args.chunk_size,
+            workers=args.workers,
+            progress=lambda ok, bad: print(f"   импортировано: {ok}, с ошибками: {bad}"),
+        )
+    for err in report["errors"]:
+        print(f"   ❌ строка {err['row']}: {err['error']}")
+    if "error" in report:
+        print(f"❌ Импорт прерван: {report['error']}")
+    print(f"✅ Готово, импортировано: {report['imported']}, с ошибками: {report['failed']}")
+
+
+def cmd_export_wallets(args):
+    """Экспортирует кошельки владельца в зашифрованный файл"""
+    from vault_backup import export_wallets
+
+    master_key = args.master_key or getpass.getpass("Мастер-ключ: ")
+    print(f"📤 Экспорт кошельков в {args.out}...")
+    with open(args.out, "w", encoding="utf-8", newline="\n") as f:
+        count = export_wallets(master_key, f)
+    print(f"✅ Готово, экспортировано записей: {count}")
+
+
+def cmd_backup(args):
+    """Делает горячую резервную копию всей базы данных"""
+    from vault_backup import backup_database
+
+    print(f"💾 Резервное копирование в {args.dest}...")
+    backup_database(
+        args.dest,
+        pages=args.pages,
+        progress=lambda remaining, total: print(f"   скопировано страниц: {total - remaining}/{total}"),
+    )
+    print("✅ Готово")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Служебные команды keySecret")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("migrate-wallets", help="перевести кошельки в новый формат записи")
+    p.add_argument("--batch-size", type=int, default=500, help="строк в одной транзакции")
+    p.set_defaults(func=cmd_migrate_wallets)
+
+    p = sub.add_parser("index-wallets", help="построить индекс поиска по именам кошельков")
+    p.add_argument("--batch-size", type=int, default=500, help="строк в одной транзакции")
+    p.set_defaults(func=cmd_index_wallets)
+
+    p = sub.add_parser("migrate-owners", help="заменить привязку по mk_name на owner_id")
+    p.add_argument("--batch-size", type=int, default=500, help="строк в одной транзакции")
+    p.set_defaults(func=cmd_migrate_owners)
+
+    p = sub.add_parser("archive-requests", help="перенести старые обработанные запросы в архив")
+    p.add_argument("--days", type=float, default=None, help="возраст запросов в днях (по умолчанию KS_REQUEST_ARCHIVE_DAYS)")
+    p.add_argument("--batch-size", type=int, default=500, help="строк в одной транзакции")
+    p.set_defaults(func=cmd_archive_requests)
+
+    p = sub.add_parser("import-wallets", help="массово импортировать кошельки из CSV / JSON")
+    p.add_argument("file", help="файл .csv, .json или .ndjson")
+    p.add_argument("--master-key", help="мастер-ключ владельца (если не указан — будет запрошен)")
+    p.add_argument("--format", choices=["csv", "json", "ndjson", "ksexport"], help="формат файла (по умолчанию — по расширению)")
+    p.add_argument("--chunk-size", type=int, default=None, help="записей в одной транзакции")
+    p.add_argument("--workers", type=int, default=None, help="процессов для шифрования")
+    p.set_defaults(func=cmd_import_wallets)
+
+    p = sub.add_parser("export-wallets", help="экспортировать кошельки в зашифрованный файл")
+    p.add_argument("out", help="файл экспорта (.ksexport)")
+    p.add_argument("--master-key", help="мастер-ключ владельца (если не указан — будет запрошен)")
+    p.set_defaults(func=cmd_export_wallets)
+
+    p = sub.add_parser("backup", help="горячая резервная копия users.db")
+    p.add_argument("dest", help="путь к файлу резервной копии")
+    p.add_argument("--pages", type=int, default=256, help="страниц за один шаг копирования")
+    p.set_defaults(func=cmd_backup)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        args.func(args)
+    except KeyboardInterrupt:
+        print("\n⛔ Прервано")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
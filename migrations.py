@@ -0,0 +1,235 @@
+"""
+Версионированные миграции схемы users.db.
+
+Текущая версия схемы хранится в PRAGMA user_version. Каждый шаг миграции
+выполняется в своей транзакции вместе с повышением user_version, поэтому
+уже примененные шаги не повторяются, а прерванная миграция продолжается с
+того же места. Новые изменения схемы добавляются только новыми шагами в
+конец MIGRATIONS — существующие шаги не редактируются.
+"""
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _add_column(conn, table, column, definition):
+    # Столбцы могли быть добавлены до появления миграций — не дублируем их
+    if column not in _columns(conn, table):
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def _base_tables(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        master_key TEXT UNIQUE NOT NULL
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS wallets (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        login TEXT NOT NULL,
+        password TEXT NOT NULL,
+        host TEXT NOT NULL,
+        mk_name TEXT NOT NULL
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS master_key_requests (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        from_user TEXT NOT NULL,
+        to_user TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending'
+    )
+    ''')
+
+
+def _wallet_record_format(conn):
+    # Формат записи: 1 — четыре отдельных токена Fernet в name/login/password/host,
+    # 2 — все поля одним токеном в data (старые колонки заполняются пустыми строками),
+    # 3 — см. _wallet_secrets
+    _add_column(conn, "wallets", "version", "INTEGER NOT NULL DEFAULT 1")
+    _add_column(conn, "wallets", "data", "TEXT")
+
+
+def _wallet_name_index(conn):
+    # Слепой индекс по названию: HMAC от n-грамм имени, ключ выводится из мастер-ключа
+    _add_column(conn, "wallets", "name_indexed", "INTEGER NOT NULL DEFAULT 0")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS wallet_name_tokens (
+        token TEXT NOT NULL,
+        wallet_id INTEGER NOT NULL,
+        PRIMARY KEY (token, wallet_id)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_wallet_name_tokens_wallet ON wallet_name_tokens(wallet_id)")
+
+
+def _wallet_owner_id(conn):
+    # Владелец записи: HMAC от мастер-ключа вместо 4-символьного префикса mk_name
+    _add_column(conn, "wallets", "owner_id", "TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_wallets_owner_id ON wallets(owner_id)")
+
+
+def _lookup_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_wallets_mk_name ON wallets(mk_name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_requests_to_user ON master_key_requests(to_user)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_requests_from_user ON master_key_requests(from_user)")
+
+
+def _sessions(conn):
+    # Серверные сессии веб-версии (session_store.SqliteSessionStore); id — SHA-256 идентификатора из cookie
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS sessions (
+        id TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        expires REAL NOT NULL
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions(expires)")
+
+
+def _wallet_secrets(conn):
+    # Формат записи 3: в data — поля для списка (name, host), в secret — логин и пароль
+    _add_column(conn, "wallets", "secret", "TEXT")
+
+
+def _change_versions(conn):
+    # Счетчики изменений: scope (например, "wallets:<owner_id>") -> номер последнего изменения.
+    # wallets.changed — номер изменения, на котором запись появилась или изменилась
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS change_versions (
+        scope TEXT PRIMARY KEY,
+        version INTEGER NOT NULL
+    ) WITHOUT ROWID
+    ''')
+    _add_column(conn, "wallets", "changed", "INTEGER NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_wallets_owner_changed ON wallets(owner_id, changed)")
+
+
+def _request_versions(conn):
+    # master_key_requests.changed — номер изменения из счетчика "requests:<to_user>"
+    _add_column(conn, "master_key_requests", "changed", "INTEGER NOT NULL DEFAULT 0")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_requests_to_user_changed ON master_key_requests(to_user, changed)")
+
+
+def _request_archive(conn):
+    # Время создания и обработки запроса; обработанные старые запросы переносятся
+    # в master_key_requests_archive (см. init_db.archive_requests)
+    _add_column(conn, "master_key_requests", "created_at", "REAL")
+    _add_column(conn, "master_key_requests", "resolved_at", "REAL")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_requests_to_user_status ON master_key_requests(to_user, status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_requests_status_resolved ON master_key_requests(status, resolved_at)")
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS master_key_requests_archive (
+        id INTEGER PRIMARY KEY,
+        from_user TEXT NOT NULL,
+        to_user TEXT NOT NULL,
+        status TEXT NOT NULL,
+        changed INTEGER NOT NULL DEFAULT 0,
+        created_at REAL,
+        resolved_at REAL,
+        archived_at REAL NOT NULL
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_requests_archive_to_user ON master_key_requests_archive(to_user, status)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_requests_archive_from_user ON master_key_requests_archive(from_user, status)")
+
+
+def _pending_request_unique(conn):
+    # Не больше одного ожидающего запроса на пару (from_user, to_user): дубликаты
+    # удаляются (остается самый ранний), повторная отправка становится no-op
+    affected = [row[0] for row in conn.execute('''
+    SELECT DISTINCT to_user FROM master_key_requests
+    WHERE status='pending' GROUP BY from_user, to_user HAVING COUNT(*) > 1
+    ''')]
+    conn.execute('''
+    DELETE FROM master_key_requests
+    WHERE status='pending' AND id NOT IN (
+        SELECT MIN(id) FROM master_key_requests WHERE status='pending' GROUP BY from_user, to_user
+    )
+    ''')
+    # Списки получателей изменились — их ETag не должны совпадать с прежними
+    for to_user in affected:
+        conn.execute(
+            "INSERT INTO change_versions (scope, version) VALUES (?, 1) "
+            "ON CONFLICT(scope) DO UPDATE SET version=version+1",
+            (f"requests:{to_user}",)
+        )
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_requests_pending_unique "
+        "ON master_key_requests(from_user, to_user) WHERE status='pending'"
+    )
+
+
+def _request_resolved_backfill(conn):
+    # Запросы, обработанные до появления resolved_at, считаются обработанными в момент
+    # миграции: иначе первая же архивация унесла бы их все, каким бы ни был срок
+    conn.execute(
+        "UPDATE master_key_requests SET resolved_at=(julianday('now') - 2440587.5) * 86400.0 "
+        "WHERE status IN ('accepted', 'rejected') AND resolved_at IS NULL"
+    )
+    # reset — номер изменения, удалившего записи (архивация, удаление дубликатов):
+    # по since= удаления не передаются, поэтому клиенту с since < reset отдается весь список
+    _add_column(conn, "change_versions", "reset", "INTEGER NOT NULL DEFAULT 0")
+    # Дубликаты, удаленные шагом _pending_request_unique, клиенты по since= так и не увидели
+    conn.execute("UPDATE change_versions SET version=version+1, reset=version+1 WHERE scope LIKE 'requests:%'")
+
+
+def _legacy_wallets_index(conn):
+    # Выборки кошельков идут только по owner_id (индекс idx_wallets_owner_id —
+    # фактически (owner_id, id)); строки без owner_id ищутся отдельно по этому
+    # частичному индексу, который не содержит строк с уже назначенным владельцем
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_wallets_legacy_mk_name ON wallets(mk_name) WHERE owner_id IS NULL")
+
+
+# Порядок важен: номер версии схемы — позиция шага в списке, начиная с 1
+MIGRATIONS = [
+    _base_tables,
+    _wallet_record_format,
+    _wallet_name_index,
+    _wallet_owner_id,
+    _lookup_indexes,
+    _sessions,
+    _wallet_secrets,
+    _change_versions,
+    _request_versions,
+    _request_archive,
+    _pending_request_unique,
+    _request_resolved_backfill,
+    _legacy_wallets_index,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def apply_migrations(conn) -> int:
+    """Применяет недостающие шаги миграции и возвращает итоговую версию схемы.
+
+    BEGIN IMMEDIATE берет блокировку записи до чтения user_version, поэтому
+    несколько процессов, стартующих одновременно, не применят шаг дважды.
+    """
+    if schema_version(conn) >= SCHEMA_VERSION:
+        return schema_version(conn)
+
+    if conn.in_transaction:
+        conn.commit()
+    for number, step in enumerate(MIGRATIONS, start=1):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if schema_version(conn) < number:
+                step(conn)
+                conn.execute(f"PRAGMA user_version = {number}")
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return schema_version(conn)
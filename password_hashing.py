@@ -0,0 +1,98 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import bcrypt
+
+
+# Стоимость bcrypt для новых хешей: каждый +1 удваивает время хеширования и проверки
+BCRYPT_ROUNDS = int(os.environ.get("KS_BCRYPT_ROUNDS", "12"))
+# Перехешировать ли при входе пароли, сохраненные с другой стоимостью
+BCRYPT_REHASH = os.environ.get("KS_BCRYPT_REHASH", "1") != "0"
+
+# Параллельно выполняемые операции bcrypt и допустимая очередь сверх них
+HASH_WORKERS = int(os.environ.get("KS_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+HASH_QUEUE = int(os.environ.get("KS_HASH_QUEUE", "16"))
+HASH_TIMEOUT = float(os.environ.get("KS_HASH_TIMEOUT", "10"))
+
+
+class HashingBusy(Exception):
+    """Пул хеширования паролей перегружен — запрос нужно отклонить."""
+
+
+def hash_password(password: str) -> str:
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
+
+
+def verify_password(password: str, hashed: str) -> bool:
+    return bcrypt.checkpw(password.encode(), hashed.encode())
+
+
+def hash_rounds(hashed: str) -> int:
+    """Стоимость, с которой создан хеш вида $2b$12$..."""
+    return int(hashed.split("$")[2])
+
+
+def needs_rehash(hashed: str) -> bool:
+    """True, если хеш создан не с текущей стоимостью BCRYPT_ROUNDS."""
+    if not BCRYPT_REHASH:
+        return False
+    try:
+        return hash_rounds(hashed) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return False
+
+
+class BoundedExecutor:
+    """Пул потоков с ограничением на число задач в работе и в очереди.
+
+    bcrypt отпускает GIL, поэтому проверки паролей идут параллельно, но не
+    больше max_workers одновременно. Если занято max_workers + max_queue
+    мест, submit() сразу бросает HashingBusy вместо ожидания.
+    """
+
+    def __init__(self, max_workers: int, max_queue: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ks-hash")
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+
+    def submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def run(self, fn, *args, timeout: float = None):
+        """Выполняет fn в пуле и ждет результат не дольше timeout секунд."""
+        future = self.submit(fn, *args)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise HashingBusy()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def hashing_executor() -> BoundedExecutor:
+    """Общий ограниченный пул хеширования паролей (создается при первом обращении)."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = BoundedExecutor(HASH_WORKERS, HASH_QUEUE)
+    return _executor
+
+
+def run_hashing(fn, *args):
+    """Выполняет fn (проверку или создание пароля) в общем ограниченном пуле.
+
+    Бросает HashingBusy, если пул переполнен или результат не готов за HASH_TIMEOUT.
+    """
+    return hashing_executor().run(fn, *args, timeout=HASH_TIMEOUT)
@@ -0,0 +1,57 @@
+"""
+Ограничение частоты действий пользователя (token bucket).
+
+У каждого ключа (имени пользователя) есть «ведро» на burst жетонов, которое
+пополняется со скоростью rate жетонов в минуту; действие забирает один
+жетон. Пустое ведро — ответ 429 с Retry-After. Ведра хранятся в памяти
+процесса (LRU на max_keys ключей), поэтому при нескольких воркерах gunicorn
+итоговый предел умножается на их число.
+"""
+
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+REQUEST_RATE = float(os.environ.get("KS_REQUEST_RATE", "10"))
+REQUEST_BURST = int(os.environ.get("KS_REQUEST_BURST", "5"))
+
+
+class RateLimiter:
+    """Token bucket на ключ: burst действий подряд, затем rate_per_minute в минуту."""
+
+    def __init__(self, rate_per_minute: float, burst: int, max_keys: int = 10000, clock=time.monotonic):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        self._clock = clock
+        self._buckets = OrderedDict()  # ключ -> (жетоны, время последнего пополнения)
+        self._lock = threading.Lock()
+
+    def acquire(self, key) -> float:
+        """Забирает жетон ключа. Возвращает 0, если действие разрешено, иначе — сколько секунд ждать."""
+        now = self._clock()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / self.rate if self.rate > 0 else math.inf
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                # Вытесненное ведро давно не использовалось и почти наверняка полное
+                self._buckets.popitem(last=False)
+        return wait
+
+
+def retry_after(wait: float) -> str:
+    """Значение заголовка Retry-After в целых секундах."""
+    return str(max(1, math.ceil(min(wait, 86400))))
+
+
+# Отправка запросов на мастер-ключ (/api/requests, /share_key)
+request_limiter = RateLimiter(REQUEST_RATE, REQUEST_BURST)
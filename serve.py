@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Продакшен-запуск веб-версии keySecret.
+
+Выбирает сервер по доступности:
+- gunicorn (Linux/macOS): несколько процессов-воркеров, в каждом пул потоков
+  (gthread), keep-alive, плавный перезапуск по SIGHUP и перезапуск воркера
+  после max-requests запросов;
+- waitress (в т.ч. Windows): один процесс с пулом потоков;
+- встроенный сервер Werkzeug — только как запасной вариант, с предупреждением.
+
+Настройки берутся из аргументов командной строки, по умолчанию — из
+переменных окружения KS_HOST, KS_PORT, KS_WORKERS, KS_THREADS, KS_KEEPALIVE,
+KS_MAX_REQUESTS, KS_GRACEFUL_TIMEOUT. При нескольких воркерах gunicorn сессии
+по умолчанию хранятся в SQLite (KS_SESSION_BACKEND=sqlite).
+"""
+
+import argparse
+import os
+import sys
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.environ.get(name, str(default)))
+
+
+def build_parser() -> argparse.ArgumentParser:
+    cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="Продакшен-сервер keySecret")
+    parser.add_argument("--host", default=os.environ.get("KS_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=_env_int("KS_PORT", 5000))
+    parser.add_argument("--workers", type=int, default=_env_int("KS_WORKERS", cpus),
+                        help="число процессов (только gunicorn)")
+    parser.add_argument("--threads", type=int, default=_env_int("KS_THREADS", 8),
+                        help="потоков на процесс")
+    parser.add_argument("--keepalive", type=int, default=_env_int("KS_KEEPALIVE", 5),
+                        help="секунд держать keep-alive соединение (только gunicorn)")
+    parser.add_argument("--max-requests", type=int, default=_env_int("KS_MAX_REQUESTS", 10000),
+                        help="перезапускать воркер после N запросов, 0 — никогда (только gunicorn)")
+    parser.add_argument("--graceful-timeout", type=int, default=_env_int("KS_GRACEFUL_TIMEOUT", 30),
+                        help="секунд на завершение запросов при перезапуске (только gunicorn)")
+    parser.add_argument("--server", choices=("auto", "gunicorn", "waitress", "werkzeug"),
+                        default=os.environ.get("KS_SERVER", "auto"))
+    return parser
+
+
+def load_app():
+    """Импортирует приложение и применяет миграции БД (идемпотентно, под блокировкой записи)."""
+    from init_db import init
+    from web_app import app
+
+    init()
+    return app
+
+
+def run_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+
+    options = {
+        "bind": f"{args.host}:{args.port}",
+        "workers": args.workers,
+        "worker_class": "gthread",
+        "threads": args.threads,
+        "keepalive": args.keepalive,
+        "graceful_timeout": args.graceful_timeout,
+        "max_requests": args.max_requests,
+        # Разброс, чтобы воркеры не перезапускались одновременно
+        "max_requests_jitter": args.max_requests // 10,
+        # Приложение загружается в каждом воркере после fork: соединения SQLite
+        # и пулы потоков не переходят из мастер-процесса, а новые воркеры после
+        # SIGHUP импортируют код заново. Поэтому мастер не импортирует ни
+        # web_app, ни init_db
+        "preload_app": False,
+    }
+
+    class KeySecretApplication(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # Миграции применяет первый воркер; остальные ждут его на BEGIN IMMEDIATE
+            return load_app()
+
+    KeySecretApplication().run()
+
+
+def run_waitress(app, args):
+    from waitress import serve
+
+    serve(app, host=args.host, port=args.port, threads=args.threads)
+
+
+def run_werkzeug(app, args):
+    print("⚠️  gunicorn и waitress не установлены — используется отладочный сервер Werkzeug.")
+    print("   Установите один из них: pip install gunicorn (Linux/macOS) или pip install waitress")
+    app.run(host=args.host, port=args.port, threaded=True, use_reloader=False)
+
+
+def pick_server(name: str) -> str:
+    if name != "auto":
+        return name
+    if sys.platform != "win32":
+        try:
+            import gunicorn  # noqa: F401
+            return "gunicorn"
+        except ImportError:
+            pass
+    try:
+        import waitress  # noqa: F401
+        return "waitress"
+    except ImportError:
+        return "werkzeug"
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    server = pick_server(args.server)
+    if server == "gunicorn" and args.workers > 1:
+        # Сессии в памяти одного воркера не видны остальным
+        os.environ.setdefault("KS_SESSION_BACKEND", "sqlite")
+
+    print(f"🚀 keySecret: {server} на http://{args.host}:{args.port}")
+    if server == "gunicorn":
+        run_gunicorn(args)
+    elif server == "waitress":
+        run_waitress(load_app(), args)
+    else:
+        run_werkzeug(load_app(), args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+"""
+Серверное хранилище сессий веб-версии.
+
+В cookie лежит только случайный идентификатор сессии, а ее содержимое
+(имя пользователя, мастер-ключ, flash-сообщения) хранится на сервере:
+- MemorySessionStore — LRU в памяти процесса с ограничением размера и
+  временем жизни; подходит для одного процесса (GUI, waitress);
+- SqliteSessionStore — таблица sessions в users.db; общая для всех
+  воркеров gunicorn.
+
+Истечение срока жизни сессии отсчитывается от последнего обращения. При
+удалении или истечении сессии вызывается on_discard(data) — веб-приложение
+стирает по нему производные ключи мастер-ключа из кеша.
+"""
+
+import hashlib
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from init_db import db_connection
+
+
+SESSION_BACKEND = os.environ.get("KS_SESSION_BACKEND", "memory")
+SESSION_TTL = int(os.environ.get("KS_SESSION_TTL", "43200"))
+SESSION_MAX = int(os.environ.get("KS_SESSION_MAX", "10000"))
+
+
+def new_session_id() -> str:
+    return secrets.token_urlsafe(32)
+
+
+class MemorySessionStore:
+    """LRU сессий в памяти процесса с ограничением размера и TTL.
+
+    Срок продлевается при каждом обращении и переносит сессию в конец LRU,
+    поэтому сессии упорядочены по сроку истечения: истекшие снимаются с
+    начала очереди при каждом get/save, не дожидаясь вытеснения.
+    """
+
+    def __init__(self, max_size: int = SESSION_MAX, ttl: float = SESSION_TTL, on_discard=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_discard = on_discard
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _discard(self, items):
+        if self.on_discard:
+            for data in items:
+                self.on_discard(data)
+
+    def _pop_expired(self, now: float) -> list:
+        """Снимает истекшие сессии с начала LRU; вызывается под self._lock."""
+        discarded = []
+        while self._data:
+            sid, (expires, data) = next(iter(self._data.items()))
+            if expires > now:
+                break
+            del self._data[sid]
+            discarded.append(data)
+        return discarded
+
+    def get(self, sid: str):
+        now = time.monotonic()
+        with self._lock:
+            discarded = self._pop_expired(now)
+            item = self._data.get(sid)
+            if item is not None:
+                self._data[sid] = (now + self.ttl, item[1])
+                self._data.move_to_end(sid)
+                data = dict(item[1])
+            else:
+                data = None
+        self._discard(discarded)
+        return data
+
+    def save(self, sid: str, data: dict):
+        now = time.monotonic()
+        with self._lock:
+            discarded = self._pop_expired(now)
+            self._data[sid] = (now + self.ttl, dict(data))
+            self._data.move_to_end(sid)
+            while len(self._data) > self.max_size:
+                _, (_, old) = self._data.popitem(last=False)
+                discarded.append(old)
+        self._discard(discarded)
+
+    def delete(self, sid: str):
+        with self._lock:
+            item = self._data.pop(sid, None)
+        if item is not None:
+            self._discard([item[1]])
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            discarded = self._pop_expired(time.monotonic())
+        self._discard(discarded)
+        return len(discarded)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SqliteSessionStore:
+    """Сессии в таблице sessions users.db, общие для всех процессов.
+
+    В таблице хранится SHA-256 от идентификатора, а не он сам, поэтому копия
+    БД не дает действующих cookie. Срок продлевается не на каждом запросе, а
+    когда прошла половина TTL, чтобы чтение сессии обычно обходилось без записи.
+    """
+
+    PURGE_EVERY = 100
+
+    def __init__(self, ttl: float = SESSION_TTL, on_discard=None):
+        self.ttl = ttl
+        self.on_discard = on_discard
+        self._saves = 0
+
+    @staticmethod
+    def _key(sid: str) -> str:
+        return hashlib.sha256(sid.encode()).hexdigest()
+
+    def get(self, sid: str):
+        now = time.time()
+        with db_connection() as conn:
+            row = conn.execute("SELECT data, expires FROM sessions WHERE id=?", (self._key(sid),)).fetchone()
+            if row is None:
+                return None
+            data, expires = json.loads(row[0]), row[1]
+            if expires <= now:
+                conn.execute("DELETE FROM sessions WHERE id=?", (self._key(sid),))
+                if self.on_discard:
+                    self.on_discard(data)
+                return None
+            if expires - now < self.ttl / 2:
+                conn.execute("UPDATE sessions SET expires=? WHERE id=?", (now + self.ttl, self._key(sid)))
+        return data
+
+    def save(self, sid: str, data: dict):
+        with db_connection() as conn:
+            conn.execute(
+                "INSERT INTO sessions (id, data, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET data=excluded.data, expires=excluded.expires",
+                (self._key(sid), json.dumps(data, ensure_ascii=False), time.time() + self.ttl),
+            )
+        self._saves += 1
+        if self._saves % self.PURGE_EVERY == 0:
+            self.purge_expired()
+
+    def delete(self, sid: str):
+        with db_connection() as conn:
+            row = conn.execute("SELECT data FROM sessions WHERE id=?", (self._key(sid),)).fetchone()
+            conn.execute("DELETE FROM sessions WHERE id=?", (self._key(sid),))
+        if row is not None and self.on_discard:
+            self.on_discard(json.loads(row[0]))
+
+    def purge_expired(self) -> int:
+        now = time.time()
+        with db_connection() as conn:
+            rows = conn.execute("SELECT data FROM sessions WHERE expires<=?", (now,)).fetchall()
+            conn.execute("DELETE FROM sessions WHERE expires<=?", (now,))
+        if self.on_discard:
+            for (data,) in rows:
+                self.on_discard(json.loads(data))
+        return len(rows)
+
+
+def create_store(backend: str = None, on_discard=None):
+    """Создает хранилище по имени backend ("memory" или "sqlite", по умолчанию KS_SESSION_BACKEND)."""
+    backend = backend or SESSION_BACKEND
+    if backend == "memory":
+        return MemorySessionStore(on_discard=on_discard)
+    if backend == "sqlite":
+        return SqliteSessionStore(on_discard=on_discard)
+    raise ValueError(f"неизвестное хранилище сессий: {backend}")
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+class ServerSessionInterface(SessionInterface):
+    """Подключает хранилище сессий к Flask: app.session_interface = ServerSessionInterface(store)."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.get(sid)
+            if data is not None:
+                return ServerSession(data, sid=sid)
+        # Неизвестный идентификатор из cookie не используется повторно,
+        # иначе сессию можно было бы навязать пользователю заранее
+        return ServerSession(sid=new_session_id(), new=True)
+
+    def regenerate(self, session):
+        """Выдает сессии новый идентификатор и удаляет запись со старым.
+
+        Вызывается при входе в систему: идентификатор, известный до входа,
+        после него не действует (защита от фиксации сессии).
+        """
+        if not session.new:
+            self.store.delete(session.sid)
+        session.sid = new_session_id()
+        session.new = True
+        session.modified = True
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if session.modified:
+            self.store.save(session.sid, dict(session))
+        if self.should_set_cookie(app, session):
+            response.set_cookie(
+                name,
+                session.sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
@@ -0,0 +1,146 @@
+"""
+Экспорт хранилища пользователя и горячее резервное копирование users.db.
+
+Формат экспорта (.ksexport) — текстовый файл: строка-заголовок EXPORT_MAGIC,
+затем по одному токену Fernet на строку. Каждый токен — зашифрованная
+мастер-ключом пачка записей с порядковым номером; последний токен содержит
+признак конца и общее число записей, поэтому перестановка, удаление или
+обрезка пачек обнаруживаются при чтении — еще до выдачи первой записи.
+Ни запись, ни чтение не держат в памяти больше одной пачки.
+"""
+
+import json
+import shutil
+import sqlite3
+import tempfile
+
+from cryptography.fernet import InvalidToken
+
+import init_db
+from init_db import WALLET_FIELDS, get_fernet_key, iter_wallets
+
+
+EXPORT_MAGIC = "KSEXPORT1"
+EXPORT_CHUNK = 200
+
+
+class ExportError(Exception):
+    """Файл экспорта поврежден, обрезан или зашифрован другим ключом."""
+
+
+def _seal(fernet, payload: dict) -> str:
+    return fernet.encrypt(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()).decode() + "\n"
+
+
+def iter_export(master_key: str, chunk_size: int = EXPORT_CHUNK, stats: dict = None):
+    """Выдает строки файла экспорта для всех расшифровываемых кошельков владельца.
+
+    Если передан stats, по завершении в stats["count"] записывается число записей.
+    """
+    fernet = get_fernet_key(master_key)
+    yield EXPORT_MAGIC + "\n"
+
+    seq = 0
+    total = 0
+    chunk = []
+    for entry in iter_wallets("", master_key[:4], master_key, with_secrets=True):
+        if not entry["decrypted"]:
+            continue
+        chunk.append({f: entry[f] for f in WALLET_FIELDS})
+        if len(chunk) >= chunk_size:
+            yield _seal(fernet, {"seq": seq, "records": chunk})
+            seq += 1
+            total += len(chunk)
+            chunk = []
+    if chunk:
+        yield _seal(fernet, {"seq": seq, "records": chunk})
+        seq += 1
+        total += len(chunk)
+    yield _seal(fernet, {"seq": seq, "end": True, "count": total})
+    if stats is not None:
+        stats["count"] = total
+
+
+def export_wallets(master_key: str, out, chunk_size: int = EXPORT_CHUNK) -> int:
+    """Пишет экспорт в текстовый поток out и возвращает число записей."""
+    stats = {}
+    for line in iter_export(master_key, chunk_size, stats):
+        out.write(line)
+    return stats["count"]
+
+
+def read_export(stream, master_key: str):
+    """Выдает записи (name/login/password/host) из файла экспорта.
+
+    Бросает ExportError, если заголовок неверен, ключ не подходит, пачки
+    переставлены или файл обрезан. Файл проверяется целиком до выдачи первой
+    записи, чтобы импорт не успел сохранить часть поврежденного файла;
+    поток без перемотки (тело HTTP-запроса) для этого копируется во
+    временный файл.
+    """
+    if stream.readline().strip() != EXPORT_MAGIC:
+        raise ExportError("это не файл экспорта keySecret")
+    fernet = get_fernet_key(master_key)
+    spool = None
+    if not stream.seekable():
+        spool = tempfile.TemporaryFile("w+", encoding="utf-8", newline="")
+        shutil.copyfileobj(stream, spool)
+        spool.seek(0)
+        stream = spool
+    try:
+        start = stream.tell()
+        for _ in _read_payloads(stream, fernet):
+            pass
+        stream.seek(start)
+        yield from _read_payloads(stream, fernet)
+    finally:
+        if spool is not None:
+            spool.close()
+
+
+def _read_payloads(stream, fernet):
+    """Расшифровывает пачки после заголовка и выдает их записи, сверяя порядок и итог."""
+    expected = 0
+    total = 0
+    for line in iter(stream.readline, ""):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            payload = json.loads(fernet.decrypt(line.encode()))
+        except InvalidToken:
+            raise ExportError("неверный мастер-ключ или поврежденная пачка")
+        if payload.get("seq") != expected:
+            raise ExportError("нарушен порядок пачек")
+        expected += 1
+        if payload.get("end"):
+            if payload.get("count") != total:
+                raise ExportError("число записей не совпадает")
+            return
+        for record in payload["records"]:
+            total += 1
+            yield record
+    raise ExportError("файл экспорта обрезан")
+
+
+def backup_database(dest_path: str, pages: int = 256, sleep: float = 0.05, progress=None):
+    """Горячая копия всей БД через online backup API SQLite.
+
+    Копирование идет шагами по pages страниц; между шагами блокировка чтения
+    снимается, поэтому запись в рабочую БД не останавливается на все время
+    копирования. progress(remaining, total) вызывается после каждого шага.
+    """
+    src = sqlite3.connect(init_db.DB_NAME)
+    dst = sqlite3.connect(dest_path)
+    try:
+        def on_step(status, remaining, total):
+            if progress:
+                progress(remaining, total)
+
+        src.backup(dst, pages=pages, progress=on_step, sleep=sleep)
+        result = dst.execute("PRAGMA quick_check").fetchone()[0]
+        if result != "ok":
+            raise sqlite3.DatabaseError(f"резервная копия не прошла проверку: {result}")
+    finally:
+        dst.close()
+        src.close()
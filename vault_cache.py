@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class VaultCache:
+    """Кэш расшифрованных хранилищ в памяти процесса, ключ — owner_id.
+
+    Объем ограничен суммарным числом записей ``max_rows`` по всем
+    хранилищам (LRU), каждое хранилище живет ``ttl`` секунд. Хранилище
+    больше ``max_rows`` не кэшируется.
+
+    Запись в БД сбрасывает кэш владельца через ``invalidate()`` после
+    фиксации транзакции. Чтобы хранилище, прочитанное до записи, не попало
+    в кэш после сброса, чтение начинается с ``begin()``, а ``put()``
+    отбрасывает результат, если с того момента владелец сбрасывался.
+
+    ``invalidate()`` видит только свой процесс, поэтому рядом с хранилищем
+    хранится номер изменения владельца (счетчик change_versions), прочитанный
+    до чтения хранилища. ``get()`` получает текущий номер из БД и при
+    несовпадении отбрасывает запись — так запись в другом воркере gunicorn
+    не оставляет здесь устаревшее хранилище до истечения ttl.
+    """
+
+    # Сколько владельцев помнить в журнале сбросов до его обнуления
+    MAX_TRACKED = 1024
+
+    def __init__(self, max_rows: int = 20000, ttl: float = 300.0):
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._rows = 0
+        self._epoch = 0
+        self._floor = 0
+        self._invalidated = {}
+        self._lock = threading.Lock()
+
+    def get(self, owner, version: int = None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(owner)
+            if item is not None and item[1] > now and (version is None or item[2] == version):
+                self._items.move_to_end(owner)
+                self.hits += 1
+                return item[0]
+            if item is not None:
+                self._drop(owner)
+            self.misses += 1
+            return None
+
+    def begin(self) -> int:
+        """Отметка начала чтения хранилища для последующего put()."""
+        with self._lock:
+            return self._epoch
+
+    def put(self, owner, entries: tuple, started: int, version: int = None) -> bool:
+        with self._lock:
+            if started < self._floor or self._invalidated.get(owner, -1) > started:
+                return False
+            if len(entries) > self.max_rows:
+                return False
+            self._drop(owner)
+            self._items[owner] = (entries, time.monotonic() + self.ttl, version)
+            self._rows += len(entries)
+            while self._rows > self.max_rows:
+                self._drop(next(iter(self._items)))
+            return True
+
+    def _drop(self, owner):
+        item = self._items.pop(owner, None)
+        if item is not None:
+            self._rows -= len(item[0])
+
+    def invalidate(self, owner):
+        with self._lock:
+            self._epoch += 1
+            self._drop(owner)
+            self._invalidated[owner] = self._epoch
+            if len(self._invalidated) > self.MAX_TRACKED:
+                self._invalidated.clear()
+                self._floor = self._epoch
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._floor = self._epoch
+            self._invalidated.clear()
+            self._items.clear()
+            self._rows = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "vaults": len(self._items), "rows": self._rows}
@@ -0,0 +1,159 @@
+"""
+Массовый импорт кошельков из CSV / JSON.
+
+Записи читаются потоком, шифруются пачками (при нескольких workers — в пуле
+процессов) и вставляются в БД через executemany, по одной транзакции на
+пачку. Ошибки отдельных строк не прерывают импорт и возвращаются в отчете.
+Если вход обрывается посреди потока (битый CSV, обрезанный файл), уже
+вставленные пачки остаются в БД, а отчет возвращается с полем "error".
+"""
+
+import csv
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from init_db import WALLET_FIELDS, db_connection, prepare_wallet, insert_wallets, invalidate_vaults
+from vault_backup import ExportError, read_export
+
+
+IMPORT_CHUNK = int(os.environ.get("KS_IMPORT_CHUNK", "500"))
+IMPORT_WORKERS = int(os.environ.get("KS_IMPORT_WORKERS", str(os.cpu_count() or 1)))
+
+
+class BadRecord:
+    """Строка входа, которую не удалось разобрать; попадает в отчет как ошибка строки."""
+
+    def __init__(self, error: str):
+        self.error = error
+
+
+def read_records(stream, fmt: str, master_key: str = None):
+    """Выдает записи из текстового потока.
+
+    fmt: "csv" (заголовок name,login,password,host), "ndjson" (объект на
+    строку), "json" (массив объектов; читается целиком) или "ksexport"
+    (файл экспорта keySecret, расшифровывается master_key).
+    """
+    if fmt == "csv":
+        yield from csv.DictReader(stream)
+    elif fmt == "ndjson":
+        for line in stream:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    yield BadRecord(f"некорректный JSON: {e}")
+    elif fmt == "json":
+        data = json.load(stream)
+        if not isinstance(data, list):
+            raise ValueError("ожидается JSON-массив записей")
+        yield from data
+    elif fmt == "ksexport":
+        yield from read_export(stream, master_key)
+    else:
+        raise ValueError(f"неизвестный формат: {fmt}")
+
+
+def detect_format(filename: str = "", content_type: str = "") -> str:
+    """Определяет формат по расширению файла или Content-Type."""
+    name = filename.lower()
+    if name.endswith(".ksexport"):
+        return "ksexport"
+    if name.endswith(".csv") or "csv" in content_type:
+        return "csv"
+    if name.endswith((".ndjson", ".jsonl")) or "ndjson" in content_type:
+        return "ndjson"
+    return "json"
+
+
+def _encrypt_chunk(master_key: str, chunk: list) -> list:
+    """Шифрует пачку [(номер строки, запись)] -> [(номер, подготовленная строка | None, ошибка | None)].
+
+    Выполняется в дочернем процессе, поэтому объявлена на уровне модуля.
+    """
+    out = []
+    for row_no, record in chunk:
+        try:
+            if isinstance(record, BadRecord):
+                raise ValueError(record.error)
+            if not isinstance(record, dict):
+                raise ValueError("запись должна быть объектом")
+            values = [record.get(f) for f in WALLET_FIELDS]
+            missing = [f for f, v in zip(WALLET_FIELDS, values) if not isinstance(v, str) or not v]
+            if missing:
+                raise ValueError("не заполнены поля: " + ", ".join(missing))
+            out.append((row_no, prepare_wallet(*values, master_key), None))
+        except Exception as e:
+            out.append((row_no, None, str(e)))
+    return out
+
+
+def _chunks(records, size, report):
+    """Пачки [(номер строки, запись)].
+
+    Ошибка чтения входа пишется в report["error"]; записи, прочитанные до нее,
+    еще выдаются последней пачкой.
+    """
+    chunk = []
+    try:
+        for row_no, record in enumerate(records, start=1):
+            chunk.append((row_no, record))
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    except (ValueError, UnicodeDecodeError, csv.Error, ExportError) as e:
+        report["error"] = str(e)
+    if chunk:
+        yield chunk
+
+
+def import_wallets(records, master_key: str, chunk_size: int = None, workers: int = None, progress=None) -> dict:
+    """Импортирует записи (итерируемое словарей name/login/password/host).
+
+    Возвращает {"imported": N, "failed": M, "errors": [{"row": номер, "error": текст}]}.
+    Если вход не удалось дочитать, в отчете есть "error": imported — сколько
+    записей уже вставлено, записи после места ошибки не импортируются.
+    progress(imported, failed) вызывается после вставки каждой пачки.
+    workers=1 шифрует в текущем потоке (так делает веб-версия: пул процессов
+    из многопоточного сервера создавать нельзя).
+    Пачки шифруются параллельно, но в пуле одновременно не больше 2*workers
+    пачек, так что вход любого размера не читается в память целиком.
+    """
+    chunk_size = chunk_size or IMPORT_CHUNK
+    workers = IMPORT_WORKERS if workers is None else workers
+    report = {"imported": 0, "failed": 0, "errors": []}
+
+    def store(encrypted):
+        prepared = []
+        for row_no, row, error in encrypted:
+            if error:
+                report["errors"].append({"row": row_no, "error": error})
+            else:
+                prepared.append(row)
+        if prepared:
+            with db_connection() as conn:
+                insert_wallets(conn, prepared)
+            invalidate_vaults(p[3] for p in prepared)
+        report["imported"] += len(prepared)
+        report["failed"] = len(report["errors"])
+        if progress:
+            progress(report["imported"], report["failed"])
+
+    chunks = _chunks(records, chunk_size, report)
+    if workers <= 1:
+        for chunk in chunks:
+            store(_encrypt_chunk(master_key, chunk))
+        return report
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        for chunk in chunks:
+            in_flight.append(pool.submit(_encrypt_chunk, master_key, chunk))
+            if len(in_flight) >= 2 * workers:
+                store(in_flight.popleft().result())
+        while in_flight:
+            store(in_flight.popleft().result())
+    return report
@@ -1,25 +1,54 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, Response, stream_with_context
 import os
+import io
+import json
+import threading
 from functools import wraps
 
 # Единый источник данных/логики: используем функции из init_db.py,
 # чтобы сайт и GUI работали с одной и той же БД и правилами
 from init_db import (
-    create_db,
-    create_wallets_table,
-    create_requests_table,
+    init,
     add_user,
     check_user,
     add_wallet,
-    search_wallets,
+    iter_wallets,
+    get_wallet_secret,
+    wallet_changes,
+    wallet_owner_id,
     send_master_key_request,
+    REQUEST_ALREADY_PENDING,
     get_received_requests,
+    request_changes,
+    REQUEST_STATUSES,
+    get_change_version,
+    version_etag,
+    wallets_scope,
+    requests_scope,
     respond_to_request,
     get_shared_master_keys,
+    forget_master_key,
 )
+from password_hashing import run_hashing, HashingBusy
+from wallet_import import import_wallets, read_records, detect_format
+from vault_backup import iter_export
+from session_store import ServerSessionInterface, create_store
+from events import listen, sse_message, KEEPALIVE
+from rate_limit import request_limiter, retry_after
 
 app = Flask(__name__)
-app.secret_key = 'your-secret-key-change-this-in-production'
+# При нескольких воркерах ключ должен быть одинаковым во всех процессах,
+# поэтому в продакшене он задается через окружение
+app.secret_key = os.environ.get('KS_SECRET_KEY', 'your-secret-key-change-this-in-production')
+
+
+def _discard_session(data):
+    # Сессия истекла или удалена — производные ключи ее мастер-ключа больше не нужны
+    forget_master_key(data.get('master_key'))
+
+
+# В cookie хранится только идентификатор сессии, содержимое — на сервере
+app.session_interface = ServerSessionInterface(create_store(on_discard=_discard_session))
 
 
 # --- ДЕКОРАТОРЫ ---
@@ -32,6 +61,99 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def rate_limited(limiter, template=None):
+    """Ограничивает частоту POST-запросов пользователя (ставится после login_required).
+
+    При превышении отвечает 429 с Retry-After: страницей template с
+    сообщением или, без template, JSON-ом.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method == 'POST':
+                wait = limiter.acquire(session['username'])
+                if wait:
+                    headers = {'Retry-After': retry_after(wait)}
+                    message = 'Слишком много запросов, повторите попытку позже'
+                    if template:
+                        flash(message, 'error')
+                        return render_template(template), 429, headers
+                    return jsonify({"success": False, "message": message}), 429, headers
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+# --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
+
+def busy_response(template):
+    """Ответ при перегрузке пула хеширования паролей: быстро отказываем вместо ожидания."""
+    flash('Сервер перегружен, повторите попытку через несколько секунд', 'error')
+    return render_template(template), 503, {'Retry-After': '2'}
+
+def conditional_response(scope, *parts, build):
+    """Ответ с ETag по счетчику изменений scope.
+
+    Если клиент прислал If-None-Match с актуальным ETag, возвращается 304
+    без вызова build() — без чтения и расшифровки данных. Иначе ответ строит
+    build(version) по тому же номеру, из которого получен ETag: кэш процесса
+    сверяется с ним, и под актуальным ETag не окажется устаревшего тела.
+    """
+    version = get_change_version(scope)
+    etag = version_etag(scope, version, *parts)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = build(version)
+    response.set_etag(etag)
+    # Браузер хранит ответ, но каждый раз сверяет его с сервером
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# Максимальный размер страницы для /api/wallets, /search_wallets и /api/requests
+MAX_PAGE_SIZE = 1000
+# Запросов на одной странице «Входящие запросы»
+REQUESTS_PAGE_SIZE = 50
+# Поток событий держит рабочий поток WSGI-сервера, поэтому одновременных
+# потоков в процессе не больше KS_EVENTS_MAX_STREAMS, а поток без изменений
+# закрывается после KS_EVENTS_MAX_KEEPALIVES keep-alive (клиент переподключится)
+EVENTS_MAX_STREAMS = int(os.environ.get('KS_EVENTS_MAX_STREAMS', '2'))
+EVENTS_MAX_KEEPALIVES = int(os.environ.get('KS_EVENTS_MAX_KEEPALIVES', '4'))
+# Адрес потока событий, обслуживаемого asgi_app.py (например, через прокси);
+# пустой — страница «Входящие запросы» не держит поток, а опрашивает since=
+EVENTS_URL = os.environ.get('KS_EVENTS_URL', '')
+_event_streams = threading.BoundedSemaphore(EVENTS_MAX_STREAMS)
+
+
+def wallets_response(params, name_filter, master_key, version=None):
+    """Отдает кошельки списком, страницей (limit/after) или потоком NDJSON.
+
+    - без limit и format — весь список JSON-массивом, как раньше;
+    - limit=N&after=ID — страница {"items": [...], "next_after": ID | null};
+    - format=ndjson (или Accept: application/x-ndjson) — по одному объекту на
+      строку, записи расшифровываются по мере отправки ответа.
+    version — номер изменения из ETag (см. conditional_response).
+    """
+    mk_name = master_key[:4] if master_key else ''
+    after = params.get('after', 0, type=int)
+    limit = params.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+    wallets = iter_wallets(name_filter, mk_name, master_key, after_id=after, limit=limit, version=version)
+
+    ndjson = params.get('format') == 'ndjson' or \
+        request.accept_mimetypes.best == 'application/x-ndjson'
+    if ndjson:
+        def generate():
+            for entry in wallets:
+                yield json.dumps(entry, ensure_ascii=False) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    if limit is None:
+        return jsonify(list(wallets))
+    items = list(wallets)
+    next_after = items[-1]['id'] if len(items) == limit else None
+    return jsonify({"items": items, "next_after": next_after})
+
 # --- МАРШРУТЫ ---
 
 @app.route('/')
@@ -45,8 +167,12 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        user = check_user(username, password)
+        try:
+            user = run_hashing(check_user, username, password)
+        except HashingBusy:
+            return busy_response('login.html')
         if user:
+            app.session_interface.regenerate(session)
             session['username'] = user[0]
             session['master_key'] = user[1]
             flash('Добро пожаловать!', 'success')
@@ -77,13 +203,15 @@ def register():
             return render_template('register.html')
         
         try:
-            if add_user(username, password):
+            if run_hashing(add_user, username, password):
                 flash('Пользователь успешно зарегистрирован! Теперь вы можете войти в систему.', 'success')
                 print(f"Пользователь {username} успешно зарегистрирован")
                 return redirect(url_for('login'))
             else:
                 flash('Пользователь с таким именем уже существует', 'error')
                 print(f"Пользователь {username} уже существует")
+        except HashingBusy:
+            return busy_response('register.html')
         except Exception as e:
             flash(f'Ошибка при регистрации: {str(e)}', 'error')
             print(f"Ошибка регистрации: {e}")
@@ -92,6 +220,7 @@ def register():
 
 @app.route('/logout')
 def logout():
+    forget_master_key(session.get('master_key'))
     session.clear()
     flash('Вы вышли из системы', 'info')
     return redirect(url_for('login'))
@@ -126,28 +255,34 @@ def create_wallet():
 def search_wallets_api():
     name_filter = request.form.get('name_filter', '')
     master_key = request.form.get('master_key', session['master_key'])
-    mk_name = master_key[:4] if master_key else ''
-    wallets = search_wallets(name_filter, mk_name, master_key)
-    return jsonify(wallets)
+    return wallets_response(request.form, name_filter, master_key)
 
 @app.route('/master_keys')
 @login_required
 def master_keys():
-    shared_keys = get_shared_master_keys(session['username'])
+    after = request.args.get('after', 0, type=int)
+    shared_keys = get_shared_master_keys(session['username'], after_id=after, limit=REQUESTS_PAGE_SIZE)
+    next_after = shared_keys[-1][3] if len(shared_keys) == REQUESTS_PAGE_SIZE else None
     return render_template('master_keys.html', 
                          username=session['username'],
                          master_key=session['master_key'],
-                         shared_keys=shared_keys)
+                         shared_keys=shared_keys,
+                         next_after=next_after)
 
 @app.route('/share_key', methods=['GET', 'POST'])
 @login_required
+@rate_limited(request_limiter, template='share_key.html')
 def share_key():
     if request.method == 'POST':
         target_username = request.form['target_username']
         if target_username == session['username']:
             flash('Нельзя отправить запрос самому себе', 'error')
             return render_template('share_key.html')
-        if send_master_key_request(session['username'], target_username):
+        result = send_master_key_request(session['username'], target_username)
+        if result == REQUEST_ALREADY_PENDING:
+            flash(f'Запрос пользователю {target_username} уже ожидает ответа', 'info')
+            return redirect(url_for('master_keys'))
+        if result:
             flash(f'Запрос отправлен пользователю {target_username}!', 'success')
             return redirect(url_for('master_keys'))
         else:
@@ -157,15 +292,25 @@ def share_key():
 @app.route('/incoming_requests')
 @login_required
 def incoming_requests():
-    requests = get_received_requests(session['username'])
-    return render_template('incoming_requests.html', requests=requests)
+    status = request.args.get('status') or None
+    if status not in REQUEST_STATUSES:
+        status = None
+    after = request.args.get('after', 0, type=int)
+    # Версия читается до списка: страница догружает изменения после нее (см. /api/requests/events)
+    version = get_change_version(requests_scope(session['username']))
+    requests = get_received_requests(session['username'], status=status, after_id=after, limit=REQUESTS_PAGE_SIZE)
+    next_after = requests[-1][0] if len(requests) == REQUESTS_PAGE_SIZE else None
+    return render_template('incoming_requests.html', requests=requests, requests_version=version,
+                           status=status, next_after=next_after, events_url=EVENTS_URL)
 
 @app.route('/respond_request', methods=['POST'])
 @login_required
 def respond_request():
     request_id = request.form['request_id']
     accept = request.form['action'] == 'accept'
-    respond_to_request(request_id, accept)
+    if not respond_to_request(request_id, accept, session['username']):
+        flash('Запрос не найден', 'error')
+        return redirect(url_for('incoming_requests'))
     action = 'принят' if accept else 'отклонен'
     flash(f'Запрос {action}', 'success')
     return redirect(url_for('incoming_requests'))
@@ -179,11 +324,19 @@ def api_test():
 @app.route('/api/wallets', methods=['GET'])
 @login_required
 def api_wallets():
+    """Список кошельков с ETag; с since=N — только изменения, как /api/wallets/changes."""
     name_filter = request.args.get('name_filter', '')
     master_key = request.args.get('master_key', session['master_key'])
-    mk_name = master_key[:4] if master_key else ''
-    wallets = search_wallets(name_filter, mk_name, master_key)
-    return jsonify(wallets)
+    scope = wallets_scope(wallet_owner_id(master_key or ''))
+    if 'since' in request.args:
+        since = request.args.get('since', 0, type=int)
+        return conditional_response(scope, 'since', since,
+                                    build=lambda version: jsonify(wallet_changes(master_key, since, version)))
+    ndjson = request.accept_mimetypes.best == 'application/x-ndjson'
+    return conditional_response(
+        scope, name_filter, *(request.args.get(k, '') for k in ('limit', 'after', 'format')), ndjson,
+        build=lambda version: wallets_response(request.args, name_filter, master_key, version)
+    )
 
 @app.route('/api/wallets', methods=['POST'])
 @login_required
@@ -200,8 +353,60 @@ def api_create_wallet():
     else:
         return jsonify({"success": False, "message": "Ошибка создания кошелька"}), 400
 
+@app.route('/api/wallets/<int:wallet_id>/secret', methods=['GET', 'POST'])
+@login_required
+def api_wallet_secret(wallet_id):
+    """Логин и пароль одного кошелька; список кошельков их не содержит."""
+    params = request.form if request.method == 'POST' else request.args
+    master_key = params.get('master_key', session['master_key'])
+    secret = get_wallet_secret(wallet_id, master_key)
+    if secret is None:
+        return jsonify({"success": False, "message": "Кошелек не найден"}), 404
+    response = jsonify(secret)
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/api/wallets/changes', methods=['GET', 'POST'])
+@login_required
+def api_wallet_changes():
+    """Кошельки, измененные после номера since; since=0 — весь список и текущий номер."""
+    params = request.form if request.method == 'POST' else request.args
+    master_key = params.get('master_key', session['master_key'])
+    since = params.get('since', 0, type=int)
+    if request.method == 'GET':
+        scope = wallets_scope(wallet_owner_id(master_key or ''))
+        return conditional_response(scope, 'since', since,
+                                    build=lambda version: jsonify(wallet_changes(master_key, since, version)))
+    return jsonify(wallet_changes(master_key, since))
+
+@app.route('/api/wallets/import', methods=['POST'])
+@login_required
+def api_import_wallets():
+    """Массовый импорт: тело запроса — CSV, NDJSON или JSON-массив записей."""
+    master_key = request.args.get('master_key', session['master_key'])
+    fmt = request.args.get('format') or detect_format(content_type=request.content_type or '')
+    stream = io.TextIOWrapper(request.stream, encoding='utf-8')
+    # Шифрование в потоке запроса: fork пула процессов из многопоточного сервера небезопасен
+    report = import_wallets(read_records(stream, fmt, master_key), master_key, workers=1)
+    if "error" in report:
+        # Пачки до места ошибки уже сохранены — клиент должен знать, сколько именно
+        return jsonify({"success": False, "message": f"Ошибка формата: {report['error']}", **report}), 400
+    return jsonify({"success": True, **report})
+
+@app.route('/api/export', methods=['GET'])
+@login_required
+def api_export_wallets():
+    """Скачивание зашифрованного экспорта кошельков; файл формируется по мере отправки."""
+    master_key = request.args.get('master_key', session['master_key'])
+    return Response(
+        stream_with_context(iter_export(master_key)),
+        mimetype='application/octet-stream',
+        headers={'Content-Disposition': 'attachment; filename=keysecret-export.ksexport'}
+    )
+
 @app.route('/api/requests', methods=['POST'])
 @login_required
+@rate_limited(request_limiter)
 def api_send_request():
     data = request.get_json()
     target_username = data.get('target_username')
@@ -209,7 +414,10 @@ def api_send_request():
     if target_username == session['username']:
         return jsonify({"success": False, "message": "Нельзя отправить запрос самому себе"}), 400
     
-    if send_master_key_request(session['username'], target_username):
+    result = send_master_key_request(session['username'], target_username)
+    if result == REQUEST_ALREADY_PENDING:
+        return jsonify({"success": False, "message": "Запрос уже ожидает ответа"}), 409
+    if result:
         return jsonify({"success": True, "message": "Запрос отправлен"})
     else:
         return jsonify({"success": False, "message": "Пользователь не найден"}), 400
@@ -217,21 +425,101 @@ def api_send_request():
 @app.route('/api/requests', methods=['GET'])
 @login_required
 def api_get_requests():
-    requests = get_received_requests(session['username'])
-    return jsonify(requests)
+    """Входящие запросы с ETag.
+
+    - status=pending|accepted|rejected — только запросы с этим статусом;
+    - limit=N&after=ID — страница {"items": [...], "next_after": ID | null};
+    - archived=1 — архив обработанных запросов;
+    - since=N — {"version", "full", "items"} только с изменениями.
+    """
+    username = session['username']
+    if 'since' in request.args:
+        since = request.args.get('since', 0, type=int)
+        return conditional_response(requests_scope(username), 'since', since,
+                                    build=lambda version: jsonify(request_changes(username, since, version)))
+
+    status = request.args.get('status') or None
+    if status is not None and status not in REQUEST_STATUSES:
+        return jsonify({"success": False, "message": "Неизвестный статус запроса"}), 400
+    after = request.args.get('after', 0, type=int)
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+    archived = request.args.get('archived') in ('1', 'true')
+
+    def build(version):
+        items = get_received_requests(username, status=status, after_id=after, limit=limit, archived=archived)
+        if limit is None:
+            return jsonify(items)
+        next_after = items[-1][0] if len(items) == limit else None
+        return jsonify({"items": items, "next_after": next_after})
+    return conditional_response(requests_scope(username), status, after, limit, archived, build=build)
+
+def change_events(scope, last_version=None, max_keepalives=None):
+    """Поток SSE для счетчика изменений scope.
+
+    Событие "change" с {"version": N, ...} приходит сразу после изменения в
+    этом процессе (через events) или не позже KEEPALIVE секунд после
+    изменения в другом процессе — счетчик сверяется вместо keep-alive.
+    Пропущенное за время переподключения (Last-Event-ID) отдается сразу.
+    После max_keepalives keep-alive подряд поток завершается.
+    """
+    with listen(scope) as subscription:
+        version = get_change_version(scope)
+        yield 'retry: 3000\n\n'
+        if last_version is not None and last_version != version:
+            yield sse_message({"version": version}, event='change', event_id=version)
+        idle = 0
+        while True:
+            event = subscription.get(timeout=KEEPALIVE)
+            if event is None:
+                current = get_change_version(scope)
+                if current == version:
+                    idle += 1
+                    if max_keepalives is not None and idle > max_keepalives:
+                        return
+                    yield ': keep-alive\n\n'
+                    continue
+                event = {"version": current}
+            idle = 0
+            if event["version"] <= version:
+                continue
+            version = event["version"]
+            yield sse_message(event, event='change', event_id=version)
+
+@app.route('/api/requests/events')
+@login_required
+def api_request_events():
+    """Уведомления о новых и обработанных входящих запросах (text/event-stream).
+
+    Сверх EVENTS_MAX_STREAMS открытых потоков — 503 с Retry-After и retry:,
+    чтобы потоки событий не заняли все рабочие потоки сервера.
+    """
+    if not _event_streams.acquire(blocking=False):
+        retry = KEEPALIVE * 2
+        return Response(f'retry: {int(retry * 1000)}\n\n', status=503, mimetype='text/event-stream',
+                        headers={'Retry-After': retry_after(retry), 'Cache-Control': 'no-cache'})
+    last_version = request.headers.get('Last-Event-ID', type=int)
+    response = Response(
+        change_events(requests_scope(session['username']), last_version, EVENTS_MAX_KEEPALIVES),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    response.call_on_close(_event_streams.release)
+    return response
 
 @app.route('/api/requests/<int:request_id>', methods=['POST'])
 @login_required
 def api_respond_request(request_id):
     data = request.get_json()
     accept = data.get('accept', False)
-    respond_to_request(request_id, accept)
+    # Чужие запросы неотличимы от несуществующих
+    if not respond_to_request(request_id, accept, session['username']):
+        return jsonify({"success": False, "message": "Запрос не найден"}), 404
     return jsonify({"success": True, "message": "Запрос обработан"})
 
 if __name__ == '__main__':
     # Инициализация базы данных
-    create_db()
-    create_wallets_table()
-    create_requests_table()
+    init()
     
     app.run(debug=True, host='0.0.0.0', port=5000)